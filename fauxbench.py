@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import timeit
+try:
+  import fauxdns
+  import polo
+except ImportError:
+  from . import fauxdns
+  from . import polo
+assert sys.version_info.major >= 3, 'Python 3 required'
+
+DESCRIPTION = """Micro-benchmark the fauxdns codec. Measures how many packets per second can be encoded
+and decoded on the client (marco.py) side and the server (polo.py) side."""
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.add_argument('message', nargs='?', default='Yw3DJ8ZHkRxb.com',
+    help='The challenge to encode. Default: %(default)s')
+  parser.add_argument('-n', '--number', type=int, default=100000,
+    help='Packets per timing run. Default: %(default)s')
+  parser.add_argument('-r', '--repeat', type=int, default=5,
+    help='Timing runs per benchmark. The fastest is reported. Default: %(default)s')
+  return parser
+
+
+def main(argv):
+
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+
+  txn_id = b'\x12\x34'
+  digest = polo.get_hash(bytes(args.message, 'utf8'))
+  query = fauxdns.encode_dns_query(args.message, txn_id)
+  txn_id, message_encoded = fauxdns.split_dns_query(query)
+  response = fauxdns.encode_dns_response(txn_id, message_encoded, digest)
+
+  benchmarks = (
+    ('client: encode query', lambda: fauxdns.encode_dns_query(args.message, txn_id)),
+    ('client: decode response', lambda: decode_response(response)),
+    ('server: decode query', lambda: decode_query(query)),
+    ('server: encode response', lambda: fauxdns.encode_dns_response(txn_id, message_encoded, digest)),
+  )
+  for name, function in benchmarks:
+    timer = timeit.Timer(function)
+    best = min(timer.repeat(repeat=args.repeat, number=args.number))
+    print('{:<24s} {:>10,.0f} packets/sec'.format(name+':', args.number/best))
+
+
+def decode_response(response):
+  txn_id, query, answer = fauxdns.split_dns_response(response)
+  return fauxdns.extract_dns_answer(answer)
+
+
+def decode_query(query):
+  txn_id, message_encoded = fauxdns.split_dns_query(query)
+  return fauxdns.decode_dns_message(message_encoded)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import binascii
+import string
+import struct
 import sys
 import urllib.parse
 assert sys.version_info.major >= 3, 'Python 3 required'
@@ -30,56 +32,88 @@ DNS_ANSWER_HEADER = binascii.unhexlify(
 )
 
 
+TXN_ID_LEN = 2
+QUERY_HEADER_END = TXN_ID_LEN+len(DNS_QUERY_HEADER)
+# The name pointer, answer header and data length which follow the question in a response.
+ANSWER_PREFIX = struct.Struct('!H{}sH'.format(len(DNS_ANSWER_HEADER)))
+# Everything between the encoded message and the digest in a response, for the usual 2-byte
+# transaction ID, which makes the name pointer point to offset 12.
+RESPONSE_MIDDLE = DNS_QUERY_FOOTER + struct.pack('!H', 0xc000 | QUERY_HEADER_END) + DNS_ANSWER_HEADER
+DATA_LEN = struct.Struct('!H')
+LENGTH_BYTES = [bytes((length,)) for length in range(256)]
+# Characters urllib.parse.quote_plus() leaves alone.
+SAFE_BYTES = bytes(string.ascii_letters + string.digits + '_.-~', 'ascii')
+# Flags and record counts (questions, answers, authority, additional).
+HEADER = struct.Struct('!HHHHH')
+QUERY_FLAGS = 0x0100
+RESPONSE_FLAGS = 0x8180
+# Over TCP, each DNS message is prefixed with its length (RFC 1035 section 4.2.2).
+TCP_LENGTH = struct.Struct('!H')
+
+
 def encode_dns_query(message, txn_id):
-  if len(txn_id) != 2:
+  if len(txn_id) != TXN_ID_LEN:
     raise ValueError('Transaction ID {} is not 2 bytes long.'.format(txn_id))
-  query = txn_id + DNS_QUERY_HEADER
-  query += encode_dns_message(message)
-  query += DNS_QUERY_FOOTER
-  return query
+  return b''.join((txn_id, DNS_QUERY_HEADER, encode_dns_message(message), DNS_QUERY_FOOTER))
 
 
 def encode_dns_message(message):
-  message_encoded = b''
-  message_quoted = urllib.parse.quote_plus(message)
-  for field in message_quoted.split('.'):
+  message_bytes = bytes(message, 'utf8')
+  # Skip the relatively slow quote_plus() when there's nothing to quote (the usual case).
+  if message_bytes.rstrip(SAFE_BYTES):
+    message_bytes = bytes(urllib.parse.quote_plus(message), 'utf8')
+  pieces = []
+  for field in message_bytes.split(b'.'):
     length = len(field)
     if length >= 256:
       raise ValueError('Message contains a dot-delimited, url-encoded field longer than '
-                       '255 characters: {}'.format(field))
-    message_encoded += int_to_bytes(length, 1) + bytes(field, 'utf8')
-  return message_encoded
+                       '255 characters: {}'.format(str(field, 'utf8')))
+    pieces.append(LENGTH_BYTES[length])
+    pieces.append(field)
+  return b''.join(pieces)
 
 
 def split_dns_response(response):
-  txn_id = response[:2]
-  header = response[2:2+len(DNS_RESPONSE_HEADER)]
+  txn_id = response[:TXN_ID_LEN]
+  header = response[TXN_ID_LEN:QUERY_HEADER_END]
   if header != DNS_RESPONSE_HEADER:
-    raise ValueError('Malformed response header: {}'.format(header))
-  # Find the end of the null-terminated query section.
-  query_end = 2+len(DNS_RESPONSE_HEADER) + 1
+    raise ValueError('Malformed response header: {}'.format(bytes(header)))
+  # Find the end of the null-terminated query section by hopping from label to label instead of
+  # checking every byte. The first label is always there, even if it's empty (an empty message).
+  query_end = QUERY_HEADER_END
+  if query_end < len(response):
+    query_end += 1+response[query_end]
   while query_end < len(response) and response[query_end] != 0:
-    query_end += 1
+    query_end += 1+response[query_end]
   if query_end >= len(response):
     raise ValueError('Query not null-terminated.')
-  query = response[2+len(DNS_RESPONSE_HEADER):query_end+len(DNS_QUERY_FOOTER)]
+  query = response[QUERY_HEADER_END:query_end+len(DNS_QUERY_FOOTER)]
   answer = response[query_end+len(DNS_QUERY_FOOTER):]
   return txn_id, query, answer
 
 
 def extract_dns_answer(answer):
-  name_pointer = answer[:2]
-  header = answer[2:2+len(DNS_ANSWER_HEADER)]
-  data_section = answer[2+len(DNS_ANSWER_HEADER):]
+  if len(answer) < ANSWER_PREFIX.size:
+    raise ValueError('Answer is too short ({} bytes).'.format(len(answer)))
+  name_pointer, header, data_len = ANSWER_PREFIX.unpack_from(answer)
   #TODO: Allow different TTLs. Then we can still decode the data and tell that the problem is
   #      caching.
   if header != DNS_ANSWER_HEADER:
     raise ValueError('Malformed response answer header: {}'.format(header))
-  data_len = bytes_to_int(data_section[:2])
-  if len(data_section) != 2+data_len:
+  if len(answer) != ANSWER_PREFIX.size+data_len:
     raise ValueError('Data section in answer is a different length ({}) than declared ({}).'
-                     .format(len(data_section)-2, data_len))
-  return data_section[2:]
+                     .format(len(answer)-ANSWER_PREFIX.size, data_len))
+  return bytes(answer[ANSWER_PREFIX.size:])
+
+
+def is_dns_query(data):
+  """Tell whether a packet looks like one of our DNS queries (as opposed to a raw message).
+  This includes queries with several questions."""
+  if len(data) <= QUERY_HEADER_END+len(DNS_QUERY_FOOTER):
+    return False
+  flags, questions, answers, authorities, additionals = HEADER.unpack_from(data, TXN_ID_LEN)
+  return (flags == QUERY_FLAGS and questions >= 1
+          and answers == authorities == additionals == 0)
 
 
 #TODO: If the DNS query is malformed, reply with a DNS error.
@@ -87,42 +121,176 @@ def extract_dns_answer(answer):
 #      FORMERR is probably appropriate (RCODE value 1).
 
 def split_dns_query(query):
-  txn_id = query[:2]
-  header = query[2:2+len(DNS_QUERY_HEADER)]
-  message_encoded = query[2+len(DNS_QUERY_HEADER):-len(DNS_QUERY_FOOTER)]
+  """Split a query into its transaction ID and encoded message. "query" can be bytes or a
+  memoryview (e.g. into a reusable receive buffer). The results are slices of the same type."""
+  txn_id = query[:TXN_ID_LEN]
+  header = query[TXN_ID_LEN:QUERY_HEADER_END]
+  message_encoded = query[QUERY_HEADER_END:-len(DNS_QUERY_FOOTER)]
   footer = query[-len(DNS_QUERY_FOOTER):]
   if header != DNS_QUERY_HEADER:
-    raise ValueError('Malformed query header: {}'.format(header))
+    raise ValueError('Malformed query header: {}'.format(bytes(header)))
   if footer != DNS_QUERY_FOOTER:
-    raise ValueError('Malformed query footer: {}'.format(footer))
+    raise ValueError('Malformed query footer: {}'.format(bytes(footer)))
   return txn_id, message_encoded
 
 
 def decode_dns_message(message_encoded):
+  # Walk the length bytes with an index instead of re-slicing the rest of the message for each
+  # field, then decode everything at once.
   fields = []
-  message_remaining = message_encoded
-  while message_remaining:
-    field_len = message_remaining[0]
-    field_bytes = message_remaining[1:1+field_len]
-    fields.append(str(field_bytes, 'utf8'))
-    message_remaining = message_remaining[1+field_len:]
-  message_quoted = '.'.join(fields)
-  return urllib.parse.unquote_plus(message_quoted)
+  pos = 0
+  end = len(message_encoded)
+  while pos < end:
+    field_len = message_encoded[pos]
+    fields.append(message_encoded[pos+1:pos+1+field_len])
+    pos += 1+field_len
+  message_quoted = str(b'.'.join(fields), 'utf8')
+  if '%' in message_quoted or '+' in message_quoted:
+    return urllib.parse.unquote_plus(message_quoted)
+  else:
+    return message_quoted
 
 
 def encode_dns_response(txn_id, message_encoded, digest):
-  response = txn_id + DNS_RESPONSE_HEADER + message_encoded + DNS_QUERY_FOOTER
+  """Build the response to a query. The arguments can be bytes or memoryviews."""
   header_len = len(txn_id)+len(DNS_QUERY_HEADER)
+  if header_len == QUERY_HEADER_END:
+    middle = RESPONSE_MIDDLE
+  elif header_len <= 0x3fff:
+    middle = DNS_QUERY_FOOTER + struct.pack('!H', 0xc000 | header_len) + DNS_ANSWER_HEADER
+  else:
+    raise ValueError('Header length ({}) won\'t fit into a name pointer.'.format(header_len))
   try:
-    name_pointer = b'\xc0'+header_len.to_bytes(1, byteorder='big')
-  except OverflowError:
-    raise ValueError('Header length ({}) won\'t fit into a single byte.'.format(header_len))
+    digest_len = DATA_LEN.pack(len(digest))
+  except struct.error:
+    raise ValueError('Digest length ({}) won\'t fit into two bytes.'.format(len(digest)))
+  # One join() is much faster for packets this small than packing into a preallocated buffer.
+  return b''.join((txn_id, DNS_RESPONSE_HEADER, message_encoded, middle, digest_len, digest))
+
+
+def encode_dns_multi_query(messages, txn_id):
+  """Encode several messages into one query, one question per message. With a single message,
+  this is identical to encode_dns_query()."""
+  if len(txn_id) != TXN_ID_LEN:
+    raise ValueError('Transaction ID {} is not 2 bytes long.'.format(txn_id))
+  if not 1 <= len(messages) <= 0xffff:
+    raise ValueError('Can\'t put {} questions in one query.'.format(len(messages)))
+  pieces = [txn_id, HEADER.pack(QUERY_FLAGS, len(messages), 0, 0, 0)]
+  for message in messages:
+    pieces.append(encode_dns_message(message))
+    pieces.append(DNS_QUERY_FOOTER)
+  return b''.join(pieces)
+
+
+def split_dns_multi_query(query):
+  """Split a query with one or more questions into its transaction ID and a list of the encoded
+  messages, one per question."""
+  if len(query) < QUERY_HEADER_END:
+    raise ValueError('Query is too short ({} bytes).'.format(len(query)))
+  txn_id = query[:TXN_ID_LEN]
+  flags, questions, answers, authorities, additionals = HEADER.unpack_from(query, TXN_ID_LEN)
+  if flags != QUERY_FLAGS or questions < 1 or answers or authorities or additionals:
+    raise ValueError('Malformed query header: {}'.format(bytes(query[TXN_ID_LEN:QUERY_HEADER_END])))
+  messages_encoded, end = split_questions(query, questions)
+  if end != len(query):
+    raise ValueError('{} bytes of trailing data after the questions.'.format(len(query)-end))
+  return txn_id, messages_encoded
+
+
+def split_questions(packet, questions):
+  """Read "questions" questions, starting right after the header. Returns a list of their encoded
+  messages and the offset where the questions end."""
+  messages_encoded = []
+  pos = QUERY_HEADER_END
+  for i in range(questions):
+    start = pos
+    # As in split_dns_response(), the first label is always there, even if it's empty.
+    if pos < len(packet):
+      pos += 1+packet[pos]
+    while pos < len(packet) and packet[pos] != 0:
+      pos += 1+packet[pos]
+    footer = packet[pos:pos+len(DNS_QUERY_FOOTER)]
+    if footer != DNS_QUERY_FOOTER:
+      raise ValueError('Malformed footer on question {}: {}'.format(i+1, bytes(footer)))
+    messages_encoded.append(packet[start:pos])
+    pos += len(DNS_QUERY_FOOTER)
+  return messages_encoded, pos
+
+
+def encode_dns_multi_response(txn_id, messages_encoded, digests):
+  """Answer a query with several questions. Each digest goes in its own answer record, which
+  points back to the name in its question. With a single question, this is identical to
+  encode_dns_response()."""
+  if len(messages_encoded) != len(digests):
+    raise ValueError('Got {} digests for {} questions.'.format(len(digests), len(messages_encoded)))
+  pieces = [txn_id, HEADER.pack(RESPONSE_FLAGS, len(digests), len(digests), 0, 0)]
+  offsets = []
+  pos = len(txn_id)+HEADER.size
+  for message_encoded in messages_encoded:
+    offsets.append(pos)
+    pieces.append(message_encoded)
+    pieces.append(DNS_QUERY_FOOTER)
+    pos += len(message_encoded)+len(DNS_QUERY_FOOTER)
+  for offset, digest in zip(offsets, digests):
+    if offset > 0x3fff:
+      raise ValueError('Question offset ({}) won\'t fit into a name pointer.'.format(offset))
+    if len(digest) > 0xffff:
+      raise ValueError('Digest length ({}) won\'t fit into two bytes.'.format(len(digest)))
+    pieces.append(ANSWER_PREFIX.pack(0xc000 | offset, DNS_ANSWER_HEADER, len(digest)))
+    pieces.append(digest)
+  return b''.join(pieces)
+
+
+def split_dns_multi_response(response):
+  """Parse a response to a query with one or more questions.
+  Returns the transaction ID and a list of the digests in the answers, in order."""
+  if len(response) < QUERY_HEADER_END:
+    raise ValueError('Response is too short ({} bytes).'.format(len(response)))
+  txn_id = response[:TXN_ID_LEN]
+  flags, questions, answers, authorities, additionals = HEADER.unpack_from(response, TXN_ID_LEN)
+  if flags != RESPONSE_FLAGS or answers != questions or authorities or additionals:
+    raise ValueError('Malformed response header: {}'
+                     .format(bytes(response[TXN_ID_LEN:QUERY_HEADER_END])))
+  messages_encoded, pos = split_questions(response, questions)
+  digests = []
+  for i in range(answers):
+    if pos+ANSWER_PREFIX.size > len(response):
+      raise ValueError('Response ends before answer {}.'.format(i+1))
+    name_pointer, header, data_len = ANSWER_PREFIX.unpack_from(response, pos)
+    if header != DNS_ANSWER_HEADER:
+      raise ValueError('Malformed header on answer {}: {}'.format(i+1, header))
+    pos += ANSWER_PREFIX.size
+    if pos+data_len > len(response):
+      raise ValueError('Data section in answer {} is shorter than declared ({}).'
+                       .format(i+1, data_len))
+    digests.append(bytes(response[pos:pos+data_len]))
+    pos += data_len
+  if pos != len(response):
+    raise ValueError('{} bytes of trailing data after the answers.'.format(len(response)-pos))
+  return txn_id, digests
+
+
+def frame_tcp(packet):
+  """Prefix a query or response with its length, for sending over TCP."""
   try:
-    digest_len = len(digest).to_bytes(2, byteorder='big')
-  except OverflowError:
-    raise ValueError('Digest length ({}) won\'t fit into two bytes.'.format(digest_len))
-  response += name_pointer + DNS_ANSWER_HEADER + digest_len + digest
-  return response
+    return TCP_LENGTH.pack(len(packet)) + packet
+  except struct.error:
+    raise ValueError('Packet length ({}) won\'t fit into two bytes.'.format(len(packet)))
+
+
+def split_tcp_frames(data):
+  """Split data read from a TCP connection into the length-prefixed packets in it.
+  Returns a list of the complete packets and the leftover start of the next one, if any."""
+  packets = []
+  pos = 0
+  while pos+TCP_LENGTH.size <= len(data):
+    length, = TCP_LENGTH.unpack_from(data, pos)
+    end = pos+TCP_LENGTH.size+length
+    if end > len(data):
+      break
+    packets.append(data[pos+TCP_LENGTH.size:end])
+    pos = end
+  return packets, data[pos:]
 
 
 def int_to_bytes(integer, length):
@@ -0,0 +1,91 @@
+"""Connect to a host over whichever of its IPv4 or IPv6 addresses answers first, as in RFC 8305
+("Happy Eyeballs"). Shared by pings.py (Python 2) and marco.py (Python 3), so it has to run on both.
+It's separate from ipwraplib because importing that opens a netlink socket and needs distutils."""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import os
+import errno
+import select
+import socket
+import timeit
+import logging
+import collections
+
+# How long to wait for one connection attempt before starting the next, in parallel (RFC 8305).
+CONNECTION_ATTEMPT_DELAY = 0.25
+FAMILY_NAMES = {socket.AF_INET:'IPv4', socket.AF_INET6:'IPv6'}
+
+
+def interleave_addresses(addrinfo):
+  """Reorder socket.getaddrinfo() results to alternate between address families, starting with the
+  family of the first result, as RFC 8305 recommends. So whichever family the caller lists first
+  gets the head start: getaddrinfo() puts the system's preferred one first, but pings.resolve_dns()
+  always puts IPv6 first. Returns a list of (family, sockaddr) tuples."""
+  by_family = collections.OrderedDict()
+  for family, socktype, proto, canonname, sockaddr in addrinfo:
+    sockaddrs = by_family.setdefault(family, [])
+    if sockaddr not in sockaddrs:
+      sockaddrs.append(sockaddr)
+  addresses = []
+  while any(by_family.values()):
+    for family, sockaddrs in by_family.items():
+      if sockaddrs:
+        addresses.append((family, sockaddrs.pop(0)))
+  return addresses
+
+
+def connect_happy_eyeballs(addresses, timeout=2, delay=CONNECTION_ATTEMPT_DELAY, sock_timeout=None):
+  """Connect to whichever of "addresses" answers first: start an attempt on each in turn, "delay"
+  seconds apart (or as soon as the last one fails), without giving up on the earlier ones.
+  "addresses" is a list of (family, sockaddr) tuples.
+  Returns the connected socket (with "sock_timeout" set, so blocking by default), the sockaddr it's
+  connected to, and the seconds its handshake took. Raises socket.error (OSError in Python 3) if
+  none connect within "timeout" seconds."""
+  start = timeit.default_timer()
+  deadline = start + timeout
+  remaining = list(addresses)
+  pending = {}
+  next_attempt = start
+  last_error = socket.timeout('timed out')
+  try:
+    while remaining or pending:
+      now = timeit.default_timer()
+      if now >= deadline:
+        break
+      if remaining and (now >= next_attempt or not pending):
+        family, sockaddr = remaining.pop(0)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        attempt_start = timeit.default_timer()
+        error = sock.connect_ex(sockaddr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+          sock.close()
+          last_error = socket.error(error, os.strerror(error))
+          continue
+        pending[sock] = (sockaddr, attempt_start)
+        next_attempt = timeit.default_timer() + delay
+        continue
+      if remaining:
+        wait = min(deadline, next_attempt) - now
+      else:
+        wait = deadline - now
+      readable, writable, exceptional = select.select([], list(pending), [], max(wait, 0))
+      for sock in writable:
+        sockaddr, attempt_start = pending.pop(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+          sock.close()
+          last_error = socket.error(error, os.strerror(error))
+          logging.info('Could not connect to {}: {}'.format(sockaddr[0], last_error))
+          # Don't wait out the delay to try the next one.
+          next_attempt = timeit.default_timer()
+          continue
+        elapsed = timeit.default_timer() - attempt_start
+        sock.settimeout(sock_timeout)
+        return sock, sockaddr, elapsed
+  finally:
+    for sock in pending:
+      sock.close()
+  raise last_error
@@ -2,10 +2,20 @@
 from the OS like wifi SSIDs, MAC addresses, DNS queries, etc."""
 import os
 import re
+import time
+import errno
 import socket
+import threading
 import subprocess
 import distutils.spawn
 
+# rtnetlink multicast groups (from <linux/rtnetlink.h>): link changes, which include wireless
+# association events like roaming to another access point, and IPv4 route changes.
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_ROUTE = 0x40
+# Look up the network context again after this many seconds, even if no change was noticed.
+NETWORK_CONTEXT_MAX_AGE = 300
+
 
 def get_wifi_info():
   """Find out what the wifi interface name, SSID and MAC address are.
@@ -155,6 +165,114 @@ def get_mac_from_ip(ip):
     return None
 
 
+class NetworkContext(object):
+  """Cache what get_wifi_info(), get_default_route() and get_mac_from_ip() say
+  about the network, since finding out runs several commands. It's only looked
+  up again when the kernel announces a link or route change over rtnetlink
+  (including associating with a different access point), when
+  get_network_state() changes (it just reads a few files), or after "max_age"
+  seconds. The rtnetlink socket is only opened on the first get(), so importing
+  this module doesn't open one. Use the shared NETWORK_CONTEXT instead of making
+  your own."""
+
+  def __init__(self, max_age=NETWORK_CONTEXT_MAX_AGE):
+    self.max_age = max_age
+    self.state = None
+    self.context = None
+    self.expiration = None
+    self.events = None
+    self.listening = False
+    self.lock = threading.Lock()
+
+  def read_events(self):
+    """Drain the rtnetlink socket. Returns True if there were any events."""
+    if self.events is None:
+      return False
+    received = False
+    while True:
+      try:
+        if not self.events.recv(65536):
+          return received
+        received = True
+      except socket.error as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return received
+        # ENOBUFS means events were dropped, so assume something changed.
+        return True
+
+  def get(self):
+    """Returns a dict with the wifi interface ("wifi_interface"), its SSID
+    ("ssid") and access point MAC address ("mac"), the default route's interface
+    ("interface") and gateway IP ("gateway"), and, if the default route isn't
+    over the wifi interface, the gateway's MAC address ("gateway_mac"). Any of
+    them can be None."""
+    with self.lock:
+      if not self.listening:
+        self.events = open_rtnetlink_socket()
+        self.listening = True
+      state = get_network_state()
+      changed = self.read_events()
+      now = time.time()
+      if changed or state != self.state or self.context is None or now >= self.expiration:
+        self.state = state
+        self.expiration = now + self.max_age
+        wifi_interface, ssid, mac = get_wifi_info()
+        interface, gateway = get_default_route()
+        self.context = {'wifi_interface':wifi_interface, 'ssid':ssid, 'mac':mac,
+                        'interface':interface, 'gateway':gateway, 'gateway_mac':None}
+      # On a wired link, report the gateway's MAC instead. It may not be in the ARP table yet, so
+      # keep checking until it is.
+      wired = self.context['wifi_interface'] != self.context['interface']
+      if wired and self.context['gateway_mac'] is None and self.context['gateway'] is not None:
+        self.context['gateway_mac'] = get_mac_from_ip(self.context['gateway'])
+      return self.context.copy()
+
+
+def get_network_state(route_path='/proc/net/route', net_dir='/sys/class/net'):
+  """Get a snapshot of the routing table and the state of each network link,
+  which can be compared to an earlier one to tell if anything changed. Reads
+  /proc and /sys, so this only works on Linux (elsewhere, it's always None)."""
+  try:
+    with open(route_path) as route_file:
+      routes = route_file.read()
+  except IOError:
+    return None
+  links = []
+  try:
+    interfaces = sorted(os.listdir(net_dir))
+  except OSError:
+    interfaces = []
+  for interface in interfaces:
+    link = [interface]
+    for attribute in ('operstate', 'carrier_changes'):
+      try:
+        with open(os.path.join(net_dir, interface, attribute)) as attribute_file:
+          link.append(attribute_file.read())
+      except IOError:
+        link.append(None)
+    links.append(tuple(link))
+  return (routes, tuple(links))
+
+
+def open_rtnetlink_socket(groups=RTMGRP_LINK | RTMGRP_IPV4_ROUTE):
+  """Open a non-blocking netlink socket which receives the kernel's rtnetlink
+  events for "groups". Returns None if that's not possible (e.g. not Linux)."""
+  try:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)  # 0 is NETLINK_ROUTE.
+  except (AttributeError, socket.error):
+    return None
+  try:
+    sock.bind((0, groups))
+  except socket.error:
+    sock.close()
+    return None
+  sock.setblocking(False)
+  return sock
+
+
+NETWORK_CONTEXT = NetworkContext()
+
+
 def get_ip():
   """Get this machine's local IP address.
   Should return the actual one used to connect to public IP's, if multiple
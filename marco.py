@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import hashlib
+import json
 import logging
+import math
 import random
 import socket
 import string
+import struct
 import sys
+import time
 import timeit
+import urllib.parse
 import fauxdns
+import happyeyeballs
 import polo
 assert sys.version_info.major >= 3, 'Python 3 required'
 
@@ -21,10 +28,29 @@ assert sys.version_info.major >= 3, 'Python 3 required'
 FAILURE_EXIT_CODE = 7
 CACHING_EXIT_CODE = 13
 INTERCEPTION_EXIT_CODE = 17
+LOAD_DURATION = 10
+TIMEOUT = 2
+PERCENTILES = (50, 90, 99)
+BURST_COUNT = 20
+BURST_INTERVAL = 0.02
+BURST_PERCENTILES = (50, 95)
+# Linux socket options for kernel timestamps, in case this Python's socket module lacks them.
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SO_TIMESTAMPING = getattr(socket, 'SO_TIMESTAMPING', 37)
+# SO_TIMESTAMPING flags (linux/net_tstamp.h): timestamp outgoing packets in software, report
+# software timestamps, and don't loop the packet itself back with the timestamp.
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+# struct timespec: seconds and nanoseconds, as native longs.
+TIMESPEC = struct.Struct('@ll')
+# struct scm_timestamping holds three timespecs. The software timestamp is the first.
+SCM_TIMESTAMPING_LEN = 3*TIMESPEC.size
 DESCRIPTION = """Query a server to check the connection between this machine and the Internet.
 Uses a special UDP protocol to avoid caching."""
 EPILOG = """This will exit with the code 0 on a successful check (the connection works), {} if no
-connection can be made, and {} if caching is detected. If the the packet gets lost, this will hang.
+connection can be made, and {} if caching is detected. If the the packet gets lost, this will hang,
+unless you use --burst, which gives up after --timeout.
 """.format(FAILURE_EXIT_CODE, CACHING_EXIT_CODE)
 
 
@@ -39,17 +65,63 @@ def make_argparser():
   parser.add_argument('-d', '--dns', dest='protocol', action='store_const', const='dns',
     help='Use DNS as the protocol. The data will be disguised as a DNS query. Changes the default '
          'port to 53.')
+  parser.add_argument('-T', '--dns-tcp', dest='protocol', action='store_const', const='dns-tcp',
+    help='Use DNS over TCP as the protocol: the same queries as --dns, each prefixed with its '
+         'length. Useful on networks which block or throttle UDP. Unlike UDP, a lost packet won\'t '
+         'leave this hanging. Uses the same default port as --dns.')
+  parser.add_argument('-S', '--tcp-session', dest='protocol', action='store_const',
+    const='tcp-session',
+    help='Open a raw TCP session and send the challenges over the one connection, timing each '
+         'round trip separately from the TCP handshake. Needs polo.py to be run with --async or '
+         '--all.')
   parser.add_argument('-w', '--http', dest='protocol', action='store_const', const='http',
     help='Use HTTP as the protocol.')
+  parser.add_argument('-n', '--challenges', type=int, default=1,
+    help='With --dns, send this many challenges in one query, as separate questions. The server '
+         'answers each in its own answer record, so one round trip checks them all. With '
+         '--dns-tcp, send this many queries at once over one connection, without waiting for the '
+         'replies in between. With --tcp-session, send this many challenges one after another on '
+         'the session. The first challenge is the given message (if any) and the rest are random.')
   parser.add_argument('-h', '--host', default='127.0.0.1',
     help='Destination host. Give an IP address or domain name. Default: %(default)s')
   parser.add_argument('-p', '--port', type=int,
-    help='Port to send to. Default for UDP/DNS: {}. Default for TCP/HTTP: {}'
+    help='Port to send to. Default for UDP/DNS/DNS over TCP: {}. Default for TCP/HTTP: {}'
          .format(polo.UDP_PORT, polo.TCP_PORT))
   parser.add_argument('-c', '--tsv', action='store_const', dest='format', const='computer',
     default='human',
-    help='Print results in computer-readable format. Currently it will just print the latency in '
-         'milliseconds.')
+    help='Print results in computer-readable format. For a single check, this is just the latency '
+         'in milliseconds. --load, --burst and --target results are printed as tab-separated '
+         'lines.')
+  parser.add_argument('--timeout', type=float, default=TIMEOUT,
+    help='Seconds to wait before counting replies as lost: for each reply in the --load test, '
+         'for all the replies after the last challenge is sent in --burst mode, or for all the '
+         'replies with --dns-tcp. Default: %(default)s')
+  parser.add_argument('-j', '--json', type=argparse.FileType('w'),
+    help='Write the --load or --burst results to this file as JSON. Give "-" for stdout.')
+  parser.add_argument('-K', '--kernel-timestamps', action='store_true',
+    help='For a single UDP or DNS challenge, also time the round trip with the kernel\'s own '
+         'timestamps of when the packets were sent and received (Linux only). This leaves out '
+         'delays in this process, like Python scheduling. Both times are reported.')
+  parser.add_argument('-m', '--target', dest='targets', action='append', type=parse_target,
+    metavar='PROTOCOL:HOST[:PORT]',
+    help='Probe this target instead of --host. Give this option several times to probe several '
+         'targets at once, concurrently. Prints one row per target. PROTOCOL is one of {}. '
+         'Put IPv6 addresses in brackets, like "udp:[::1]:35353". '
+         'Each target gets --timeout seconds to reply.'.format(', '.join(PROBERS)))
+  burst = parser.add_argument_group('Burst mode')
+  burst.add_argument('-B', '--burst', type=int, nargs='?', const=BURST_COUNT, metavar='COUNT',
+    help='Instead of sending one message, send COUNT sequence-numbered challenges --interval apart '
+         'and wait for all the replies together. Reports loss, round trip time, jitter and '
+         'reordering. UDP and DNS only. Default COUNT: %(const)s')
+  burst.add_argument('--interval', type=float, default=BURST_INTERVAL,
+    help='Seconds between challenges in --burst mode. Default: %(default)s')
+  load = parser.add_argument_group('Load testing')
+  load.add_argument('-L', '--load', type=int, metavar='CLIENTS',
+    help='Instead of sending one message, simulate this many concurrent clients, each sending a '
+         'new challenge as soon as it gets the reply to its last one. Reports the achieved '
+         'queries per second, loss and latency percentiles. Works for all the protocols.')
+  load.add_argument('--duration', type=float, default=LOAD_DURATION,
+    help='Seconds to run the --load test. Default: %(default)s')
   parser.add_argument('-l', '--log', type=argparse.FileType('w'), default=sys.stderr,
     help='Print log messages to this file instead of to stderr. Warning: Will overwrite the file.')
   volume = parser.add_mutually_exclusive_group()
@@ -81,37 +153,155 @@ def main(argv):
   elif args.protocol == 'http':
     transport = 'tcp'
     application = 'http'
+  elif args.protocol == 'dns-tcp':
+    transport = 'tcp'
+    application = 'dns'
+  elif args.protocol == 'tcp-session':
+    transport = 'tcp'
+    application = 'session'
 
   if args.port:
     port = args.port
-  elif transport == 'udp':
+  elif transport == 'udp' or application == 'dns':
     port = polo.UDP_PORT
   elif transport == 'tcp':
     port = polo.TCP_PORT
 
-  #TODO: Use getaddrinfo() to support IPv6.
-  ip = socket.gethostbyname(args.host)
+  if args.targets:
+    results = asyncio.run(probe_targets(args.targets, timeout=args.timeout))
+    for result in results:
+      print(format_target_result(result, args.format))
+    if args.json:
+      json.dump(results, args.json, indent=2)
+      args.json.write('\n')
+    statuses = {result['status'] for result in results}
+    if 'wrong' in statuses:
+      return CACHING_EXIT_CODE
+    elif statuses != {'ok'}:
+      return FAILURE_EXIT_CODE
+    return
+
+  try:
+    addresses = get_addresses(args.host, port, transport)
+  except socket.gaierror as error:
+    fail('Error: Could not look up {}: {}'.format(args.host, error))
+  # The TCP modes race all the addresses, but UDP has no handshake to race. The other modes just use
+  # the first address, which is the one the system prefers.
+  family, sockaddr = addresses[0]
+  ip = sockaddr[0]
+
+  if args.load:
+    results = asyncio.run(run_load(ip, port, args.protocol, args.load, args.duration,
+                                   timeout=args.timeout))
+    if args.format == 'human':
+      print(format_load_results(results))
+    else:
+      print(format_load_tsv(results))
+    if args.json:
+      json.dump(results, args.json, indent=2)
+      args.json.write('\n')
+    if results['replies'] == 0:
+      return FAILURE_EXIT_CODE
+    elif results['wrong']:
+      return CACHING_EXIT_CODE
+    return
+
+  if args.burst:
+    if transport != 'udp':
+      fail('Error: --burst only works with UDP or DNS.')
+    results = asyncio.run(run_burst(ip, port, application, args.burst, args.interval,
+                                    timeout=args.timeout))
+    if args.format == 'human':
+      print(format_burst_results(results))
+    else:
+      print(format_burst_tsv(results))
+    if args.json:
+      json.dump(results, args.json, indent=2)
+      args.json.write('\n')
+    if results['received'] == 0:
+      return FAILURE_EXIT_CODE
+    elif results['wrong']:
+      return CACHING_EXIT_CODE
+    return
+
+  if args.challenges > 1 or args.protocol in ('dns-tcp', 'tcp-session'):
+    if application not in ('dns', 'session'):
+      fail('Error: --challenges only works with --dns, --dns-tcp or --tcp-session.')
+    if args.protocol == 'dns-tcp' and args.challenges > 2**16:
+      fail('Error: --dns-tcp can send at most {} --challenges, since each needs its own DNS '
+           'transaction ID.'.format(2**16))
+    messages = [args.message] + [get_rand_string(12)+'.com' for i in range(args.challenges-1)]
+    try:
+      if transport == 'udp':
+        response_digests, stats = send_dns_batch(ip, port, messages, family=family)
+      elif application == 'dns':
+        response_digests, stats = send_dns_tcp(addresses, messages, timeout=args.timeout)
+      else:
+        response_digests, stats = send_tcp_session(addresses, messages, timeout=args.timeout)
+    except ValueError as error:
+      logging.warning('Warning: Malformed response. Probably a response from a real DNS server.\n'
+                      +str(error))
+      return INTERCEPTION_EXIT_CODE
+    except OSError as error:
+      logging.critical('Error: Could not connect to remote server: {}'.format(error))
+      return FAILURE_EXIT_CODE
+    response_digests += [None] * (len(messages)-len(response_digests))
+    lost = response_digests.count(None)
+    wrong = 0
+    for message, response_digest in zip(messages, response_digests):
+      if response_digest is not None and response_digest != polo.get_hash(bytes(message, 'utf8')):
+        wrong += 1
+    if args.format == 'human':
+      if transport == 'udp':
+        print('Received response from {ip} port {port} in {elapsed:0.1f} ms.'.format(**stats))
+      else:
+        print('Connected to {ip} port {port} over {family} in {elapsed:0.1f} ms.'.format(**stats))
+        rtts = sorted(rtt for rtt in stats['rtts'] if rtt is not None)
+        if rtts:
+          print('Round trip times (ms): min {:0.1f}, median {:0.1f}, max {:0.1f}'
+                .format(rtts[0], get_percentile(rtts, 50), rtts[-1]))
+      print('{} of {} responses are as expected.'.format(len(messages)-lost-wrong, len(messages)))
+      if lost:
+        print('{} responses never arrived.'.format(lost))
+    else:
+      print('{elapsed:0.1f}'.format(**stats))
+    if lost == len(messages):
+      return FAILURE_EXIT_CODE
+    elif wrong:
+      return CACHING_EXIT_CODE
+    return
 
   message_bytes = bytes(args.message, 'utf8')
   expected_digest = polo.get_hash(message_bytes)
 
   if transport == 'udp':
     try:
-      response_digest, stats = send_udp(ip, port, args.message, application)
+      response_digest, stats = send_udp(ip, port, args.message, application, family=family,
+                                        kernel_timestamps=args.kernel_timestamps)
     except ValueError as error:
       logging.warning('Warning: Malformed response. Probably a response from a real DNS server.\n'
                       +str(error))
       return INTERCEPTION_EXIT_CODE
   elif transport == 'tcp':
-    response_digest, stats = send_tcp(ip, port, args.message, application)
+    try:
+      response_digest, stats = send_tcp(addresses, args.message, application, timeout=args.timeout,
+                                        host=args.host)
+    except OSError as error:
+      logging.critical('Error: Could not connect to remote server: {}'.format(error))
+      return FAILURE_EXIT_CODE
 
   if args.format == 'human':
     if transport == 'udp':
       print('Received response from {ip} port {port} in {elapsed:0.1f} ms.'
             .format(**stats))
+      if stats.get('kernel_elapsed') is not None:
+        print('Kernel-timestamped round trip ({kernel_method}): {kernel_elapsed:0.3f} ms. '
+              'Overhead in this process: {:0.3f} ms.'
+              .format(stats['elapsed']-stats['kernel_elapsed'], **stats))
     elif transport == 'tcp':
-      print('Connected to {} port {} in {elapsed:0.1f} ms.'
-            .format(ip, port, **stats))
+      print('Connected to {ip} port {port} over {family} in {elapsed:0.1f} ms.'.format(**stats))
+  elif stats.get('kernel_elapsed') is not None:
+    print('{elapsed:0.1f}\t{kernel_elapsed:0.3f}'.format(**stats))
   else:
     print('{elapsed:0.1f}'.format(**stats))
 
@@ -125,23 +315,34 @@ def main(argv):
     return CACHING_EXIT_CODE
 
 
-def send_udp(ip, port, message, application):
+def send_udp(ip, port, message, application, family=socket.AF_INET, kernel_timestamps=False):
   if application == 'dns':
     txn_id = get_random_bytes(2)
     message_encoded = fauxdns.encode_dns_query(message, txn_id)
   else:
     message_encoded = bytes(message, 'utf8')
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock = socket.socket(family, socket.SOCK_DGRAM)
+  kernel_stats = {}
   try:
+    if kernel_timestamps:
+      kernel_timestamps = enable_timestamps(sock)
     start = timeit.default_timer()
+    # The kernel timestamps are wall clock times, so this is the fallback when there's no send one.
+    wall_start = time.time()
     try:
       sock.sendto(message_encoded, (ip, port))
     except OSError:
       logging.critical('Error: Could not connect to remote server.')
       return FAILURE_EXIT_CODE
     logging.info('Sent query; waiting on reply..')
-    response, (remote_ip, remote_port) = sock.recvfrom(polo.BUFFER_SIZE)
+    if kernel_timestamps:
+      response, ancdata, flags, address = sock.recvmsg(polo.BUFFER_SIZE, 1024)
+    else:
+      response, address = sock.recvfrom(polo.BUFFER_SIZE)
+    remote_ip, remote_port = address[:2]
     elapsed = timeit.default_timer() - start
+    if kernel_timestamps:
+      kernel_stats = get_kernel_rtt(sock, ancdata, wall_start)
   finally:
     sock.close()
   if application == 'raw':
@@ -152,20 +353,774 @@ def send_udp(ip, port, message, application):
     if response_txn_id != txn_id:
       logging.error('Response transaction ID ({}) is different from query\'s ({}).'
                     .format(fauxdns.bytes_to_int(response_txn_id), fauxdns.bytes_to_int(txn_id)))
-  return response_digest, {'elapsed':elapsed*1000, 'ip':remote_ip, 'port':remote_port}
+  stats = {'elapsed':elapsed*1000, 'ip':remote_ip, 'port':remote_port}
+  stats.update(kernel_stats)
+  return response_digest, stats
 
 
-def send_tcp(ip, port, message, application):
-  if application == 'raw':
-    message_encoded = bytes(message+'\n', 'utf8')
-  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+def enable_timestamps(sock):
+  """Ask the kernel to timestamp packets received on "sock", and packets sent, if it supports it.
+  Returns False if it doesn't support receive timestamps."""
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+  except OSError as error:
+    logging.warning('Warning: Kernel timestamps unavailable: {}'.format(error))
+    return False
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING, SOF_TIMESTAMPING_TX_SOFTWARE
+                    | SOF_TIMESTAMPING_SOFTWARE | SOF_TIMESTAMPING_OPT_TSONLY)
+  except OSError as error:
+    logging.info('No send timestamps: {}'.format(error))
+  return True
+
+
+def get_kernel_rtt(sock, ancdata, wall_start):
+  """Compute the round trip time from the kernel's timestamps. "ancdata" is the ancillary data
+  from receiving the reply. The send timestamp is read from the socket's error queue. If there
+  isn't one, fall back to "wall_start", the time.time() just before sending.
+  Returns a dict with "kernel_elapsed" in milliseconds (or None) and "kernel_method"."""
+  received = get_cmsg_timestamp(ancdata)
+  if received is None:
+    logging.warning('Warning: The kernel didn\'t timestamp the reply.')
+    return {'kernel_elapsed':None, 'kernel_method':None}
+  sent = None
+  try:
+    data, tx_ancdata, flags, address = sock.recvmsg(1, 1024, socket.MSG_ERRQUEUE|socket.MSG_DONTWAIT)
+    sent = get_cmsg_timestamp(tx_ancdata)
+  except (BlockingIOError, InterruptedError):
+    pass
+  if sent is None:
+    return {'kernel_elapsed':(received-wall_start)*1000, 'kernel_method':'receive only'}
+  return {'kernel_elapsed':(received-sent)*1000, 'kernel_method':'send and receive'}
+
+
+def get_cmsg_timestamp(ancdata):
+  """Find a SO_TIMESTAMPNS or SO_TIMESTAMPING timestamp in ancillary data, as a float of seconds
+  since the epoch."""
+  for level, cmsg_type, cmsg_data in ancdata:
+    if level != socket.SOL_SOCKET:
+      continue
+    if cmsg_type == SO_TIMESTAMPNS or (cmsg_type == SO_TIMESTAMPING
+                                       and len(cmsg_data) >= SCM_TIMESTAMPING_LEN):
+      seconds, nanoseconds = TIMESPEC.unpack_from(cmsg_data)
+      if seconds or nanoseconds:
+        return seconds + nanoseconds/1e9
+  return None
+
+
+def send_dns_batch(ip, port, messages, family=socket.AF_INET):
+  """Send several challenges in one DNS query and return the digests from the answers, in order."""
+  txn_id = get_random_bytes(2)
+  query = fauxdns.encode_dns_multi_query(messages, txn_id)
+  if len(query) > polo.BUFFER_SIZE:
+    fail('Error: Query is too long ({} bytes) for the server to receive. Send fewer challenges.'
+         .format(len(query)))
+  with socket.socket(family, socket.SOCK_DGRAM) as sock:
     start = timeit.default_timer()
-    sock.connect((ip, port))
-    end = timeit.default_timer()
-    elapsed = end - start
+    sock.sendto(query, (ip, port))
+    logging.info('Sent query with {} challenges; waiting on reply..'.format(len(messages)))
+    # The response repeats the questions and adds an answer for each, so it's longer than the query.
+    response, address = sock.recvfrom(65535)
+    remote_ip, remote_port = address[:2]
+    elapsed = timeit.default_timer() - start
+  response_txn_id, response_digests = fauxdns.split_dns_multi_response(response)
+  if response_txn_id != txn_id:
+    logging.error('Response transaction ID ({}) is different from query\'s ({}).'
+                  .format(fauxdns.bytes_to_int(response_txn_id), fauxdns.bytes_to_int(txn_id)))
+  return response_digests, {'elapsed':elapsed*1000, 'ip':remote_ip, 'port':remote_port}
+
+
+def send_dns_tcp(addresses, messages, timeout=TIMEOUT):
+  """Send each challenge in its own DNS query over one TCP connection, all at once, then read the
+  responses, matching them to the queries by transaction ID. Returns the digests, in the order of
+  "messages", with None for any not answered within "timeout" seconds of sending."""
+  txn_ids = [fauxdns.int_to_bytes(txn_int, fauxdns.TXN_ID_LEN)
+             for txn_int in random.sample(range(2**16), len(messages))]
+  indices = {txn_id:i for i, txn_id in enumerate(txn_ids)}
+  data = b''.join(fauxdns.frame_tcp(fauxdns.encode_dns_query(message, txn_id))
+                  for message, txn_id in zip(messages, txn_ids))
+  digests = [None] * len(messages)
+  rtts = [None] * len(messages)
+  sock, sockaddr, elapsed = happyeyeballs.connect_happy_eyeballs(addresses, timeout=timeout,
+                                                                   sock_timeout=timeout)
+  with sock:
+    sock.sendall(data)
+    sent = timeit.default_timer()
+    logging.info('Sent {} queries; waiting on replies..'.format(len(messages)))
+    deadline = sent + timeout
+    remaining = len(messages)
+    buffer = b''
+    while remaining:
+      now = timeit.default_timer()
+      if now >= deadline:
+        break
+      sock.settimeout(deadline-now)
+      try:
+        chunk = sock.recv(65535)
+      except socket.timeout:
+        break
+      if not chunk:
+        break
+      received = timeit.default_timer()
+      packets, buffer = fauxdns.split_tcp_frames(buffer+chunk)
+      for packet in packets:
+        response_txn_id, query, answer = fauxdns.split_dns_response(packet)
+        i = indices.get(response_txn_id)
+        if i is None or digests[i] is not None:
+          logging.error('Response has an unexpected transaction ID ({}).'
+                        .format(fauxdns.bytes_to_int(response_txn_id)))
+          continue
+        digests[i] = fauxdns.extract_dns_answer(answer)
+        rtts[i] = (received-sent)*1000
+        remaining -= 1
+  return digests, {'elapsed':elapsed*1000, 'ip':sockaddr[0], 'port':sockaddr[1],
+                   'family':happyeyeballs.FAMILY_NAMES.get(sock.family), 'rtts':rtts}
+
+
+def send_tcp_session(addresses, messages, timeout=TIMEOUT):
+  """Open a session with polo and send the challenges one at a time over the one connection, timing
+  each round trip. Returns the digests, in order, and the stats. The handshake time is "elapsed".
+  If a reply doesn't come within "timeout" seconds, this stops, and returns only those before it."""
+  digests = []
+  rtts = []
+  sock, sockaddr, elapsed = happyeyeballs.connect_happy_eyeballs(addresses, timeout=timeout,
+                                                                   sock_timeout=timeout)
+  with sock:
+    sock.sendall(polo.SESSION_GREETING)
+    with sock.makefile('rb') as reader:
+      ack = reader.readline()
+      if ack != polo.SESSION_ACK:
+        raise ConnectionError('Server didn\'t start a session (it replied {!r}). Is polo.py running '
+                              'with --async?'.format(ack))
+      for message in messages:
+        start = timeit.default_timer()
+        sock.sendall(bytes(message+'\n', 'utf8'))
+        try:
+          prefix = reader.read(polo.SESSION_LENGTH.size)
+          if len(prefix) < polo.SESSION_LENGTH.size:
+            raise ConnectionError('Server closed the session.')
+          length, = polo.SESSION_LENGTH.unpack(prefix)
+          digest = reader.read(length)
+        except socket.timeout:
+          break
+        rtts.append((timeit.default_timer()-start)*1000)
+        digests.append(digest)
+  return digests, {'elapsed':elapsed*1000, 'ip':sockaddr[0], 'port':sockaddr[1],
+                   'family':happyeyeballs.FAMILY_NAMES.get(sock.family), 'rtts':rtts}
+
+
+def send_tcp(addresses, message, application, timeout=TIMEOUT, host=None):
+  """Send one challenge in a raw TCP or HTTP request. Returns the digest in the response (empty if
+  there was none) and the stats."""
+  if application == 'http':
+    message_encoded = format_http_request(message, host or addresses[0][1][0], keep_alive=False)
+  else:
+    message_encoded = bytes(message+'\n', 'utf8')
+  sock, sockaddr, elapsed = happyeyeballs.connect_happy_eyeballs(addresses, timeout=timeout,
+                                                                   sock_timeout=timeout)
+  with sock:
     sock.sendall(message_encoded)
-    response = sock.recv(polo.BUFFER_SIZE)
-  return response, {'elapsed':elapsed*1000, 'ip':None, 'port':None}
+    if application == 'http':
+      response = read_http_digest(sock)
+    else:
+      response = sock.recv(polo.BUFFER_SIZE)
+  return response, {'elapsed':elapsed*1000, 'ip':sockaddr[0], 'port':sockaddr[1],
+                    'family':happyeyeballs.FAMILY_NAMES.get(sock.family)}
+
+
+def read_http_digest(sock):
+  """Read an HTTP response up to the end of the connection and return the digest in it, or b'' if
+  it isn't a proper polo response."""
+  data = b''
+  while True:
+    buf = sock.recv(polo.BUFFER_SIZE)
+    if not buf:
+      break
+    data += buf
+  head, separator, body = data.partition(b'\r\n\r\n')
+  try:
+    status, headers = parse_http_response_head(head)
+  except ValueError:
+    return b''
+  return get_http_digest(status, body) or b''
+
+
+def get_addresses(host, port, transport='udp'):
+  """Look up all the IPv4 and IPv6 addresses of "host". Returns a list of (family, sockaddr)
+  tuples, alternating between the families as RFC 8305 recommends, starting with the family of the
+  system's preferred address. Raises socket.gaierror if the lookup fails."""
+  if transport == 'udp':
+    socktype = socket.SOCK_DGRAM
+  else:
+    socktype = socket.SOCK_STREAM
+  return happyeyeballs.interleave_addresses(socket.getaddrinfo(host, port, type=socktype))
+
+
+async def run_load(ip, port, protocol, clients, duration, timeout=TIMEOUT):
+  """Run "clients" concurrent closed-loop clients against a polo server for "duration" seconds.
+  Returns a dict of results, ready to be written as JSON."""
+  tally = {'sent':0, 'replies':0, 'lost':0, 'wrong':0, 'errors':0, 'latencies':[]}
+  loop = asyncio.get_running_loop()
+  start = loop.time()
+  deadline = start + duration
+  prober = PROBERS[protocol]
+  await asyncio.gather(*[run_load_client(prober, ip, port, deadline, tally, timeout)
+                         for i in range(clients)])
+  elapsed = loop.time() - start
+  latencies = sorted(tally.pop('latencies'))
+  results = {'protocol':protocol, 'ip':ip, 'port':port, 'clients':clients, 'duration':elapsed}
+  results.update(tally)
+  results['qps'] = tally['replies'] / elapsed
+  if tally['sent']:
+    results['loss_pct'] = 100 * tally['lost'] / tally['sent']
+  else:
+    results['loss_pct'] = None
+  results['latency_ms'] = summarize_latencies(latencies)
+  return results
+
+
+async def run_load_client(prober, ip, port, deadline, tally, timeout=TIMEOUT):
+  loop = asyncio.get_running_loop()
+  async with prober(ip, port) as probe:
+    while loop.time() < deadline:
+      message = get_rand_string(12)+'.com'
+      tally['sent'] += 1
+      start = loop.time()
+      try:
+        correct = await asyncio.wait_for(probe(message), timeout)
+      except asyncio.TimeoutError:
+        tally['lost'] += 1
+        continue
+      except (OSError, ValueError, asyncio.IncompleteReadError) as error:
+        logging.info('Error on probe: {}'.format(error))
+        tally['errors'] += 1
+        # Don't spin on a refused connection.
+        await asyncio.sleep(min(timeout, deadline-loop.time()))
+        continue
+      tally['replies'] += 1
+      if correct:
+        tally['latencies'].append(1000*(loop.time()-start))
+      else:
+        tally['wrong'] += 1
+
+
+def parse_target(target_str):
+  """Parse a --target argument into a (protocol, host, port) tuple. The port is None if not given."""
+  protocol, colon, address = target_str.partition(':')
+  if protocol not in PROBERS or not address:
+    raise argparse.ArgumentTypeError('Invalid target {!r}. Give a protocol ({}), then a colon and '
+                                     'a host.'.format(target_str, ', '.join(PROBERS)))
+  if address.startswith('['):
+    # An IPv6 address, like [::1]:35353.
+    host, bracket, port_str = address[1:].partition(']')
+    colon = port_str[:1]
+    port_str = port_str[1:]
+  else:
+    host, colon, port_str = address.partition(':')
+  if not colon:
+    return protocol, host, None
+  try:
+    return protocol, host, int(port_str)
+  except ValueError:
+    raise argparse.ArgumentTypeError('Invalid port in target {!r}.'.format(target_str))
+
+
+async def probe_targets(targets, timeout=TIMEOUT):
+  """Probe each (protocol, host, port) target with one challenge, all at once. Returns a list of
+  result dicts in the same order, one per target."""
+  return await asyncio.gather(*[probe_target(*target, timeout=timeout) for target in targets])
+
+
+async def probe_target(protocol, host, port=None, timeout=TIMEOUT):
+  if port is None:
+    if protocol in ('udp', 'dns', 'dns-tcp'):
+      port = polo.UDP_PORT
+    else:
+      port = polo.TCP_PORT
+  result = {'protocol':protocol, 'host':host, 'port':port, 'ip':None, 'family':None,
+            'status':None, 'elapsed':None}
+  try:
+    # The timeout covers the whole probe, including the DNS lookup and connecting.
+    correct = await asyncio.wait_for(resolve_and_probe(protocol, host, port, result), timeout)
+  except asyncio.TimeoutError:
+    result['status'] = 'timeout'
+  except (OSError, ValueError, asyncio.IncompleteReadError) as error:
+    logging.info('Error probing {} {} port {}: {}'.format(protocol, host, port, error))
+    result['status'] = 'error'
+  else:
+    result['status'] = 'ok' if correct else 'wrong'
+  return result
+
+
+async def resolve_and_probe(protocol, host, port, result):
+  loop = asyncio.get_running_loop()
+  addresses = await loop.getaddrinfo(host, port)
+  family, socktype, proto, canonname, sockaddr = addresses[0]
+  result['ip'] = sockaddr[0]
+  result['family'] = happyeyeballs.FAMILY_NAMES.get(family)
+  # Time from after the lookup, so it's comparable to the other modes. For TCP, this includes the
+  # handshake.
+  start = loop.time()
+  async with PROBERS[protocol](result['ip'], port) as probe:
+    correct = await probe(get_rand_string(12)+'.com')
+  result['elapsed'] = 1000*(loop.time()-start)
+  return correct
+
+
+def format_target_result(result, output_format='human'):
+  if output_format == 'human':
+    if result['elapsed'] is None:
+      elapsed_str = ''
+    else:
+      elapsed_str = '{:0.1f} ms'.format(result['elapsed'])
+    return '{:<12s}{:<24s}{:<7d}{:<9s}{}'.format(result['protocol'], result['host'], result['port'],
+                                              result['status'], elapsed_str).rstrip()
+  else:
+    if result['elapsed'] is None:
+      elapsed_str = ''
+    else:
+      elapsed_str = '{:0.1f}'.format(result['elapsed'])
+    return '\t'.join((result['protocol'], result['host'], str(result['port']), result['status'],
+                      elapsed_str))
+
+
+def summarize_latencies(latencies, percentiles=PERCENTILES):
+  """Summarize a sorted list of latencies in milliseconds."""
+  if not latencies:
+    return None
+  summary = {'min':latencies[0], 'mean':sum(latencies)/len(latencies), 'max':latencies[-1]}
+  for percentile in percentiles:
+    summary['p{}'.format(percentile)] = get_percentile(latencies, percentile)
+  return summary
+
+
+def get_percentile(sorted_values, percentile):
+  """Nearest-rank percentile of an already-sorted list."""
+  rank = math.ceil(percentile/100 * len(sorted_values))
+  return sorted_values[max(0, rank-1)]
+
+
+def format_load_results(results):
+  lines = ['Sent {sent} {protocol} challenges from {clients} clients in {duration:0.1f} s: '
+           '{replies} replies ({qps:0.1f}/s), {lost} lost, {wrong} wrong, {errors} errors.'
+           .format(**results)]
+  if results['loss_pct'] is not None:
+    lines.append('Loss: {:0.2f}%'.format(results['loss_pct']))
+  latency = results['latency_ms']
+  if latency:
+    percentiles = ['p{} {:0.2f}'.format(p, latency['p{}'.format(p)]) for p in PERCENTILES]
+    lines.append('Latency (ms): min {:0.2f}, mean {:0.2f}, {}, max {:0.2f}'
+                 .format(latency['min'], latency['mean'], ', '.join(percentiles), latency['max']))
+  return '\n'.join(lines)
+
+
+def format_load_tsv(results):
+  """One line: sent, replies, lost, wrong, errors, replies per second, loss %, and the min, mean,
+  percentile and max latencies. Missing values are left empty."""
+  latency = results['latency_ms'] or {}
+  fields = [results['sent'], results['replies'], results['lost'], results['wrong'],
+            results['errors'], results['qps'], results['loss_pct'], latency.get('min'),
+            latency.get('mean')]
+  fields += [latency.get('p{}'.format(p)) for p in PERCENTILES]
+  fields.append(latency.get('max'))
+  return '\t'.join('' if f is None else '{:0.2f}'.format(f) if isinstance(f, float) else str(f)
+                   for f in fields)
+
+
+async def run_burst(ip, port, application, count, interval, timeout=TIMEOUT):
+  """Send "count" sequence-numbered challenges, one every "interval" seconds, then wait until
+  "timeout" seconds after the last one for the rest of the replies. Returns a dict of results,
+  ready to be written as JSON."""
+  loop = asyncio.get_running_loop()
+  receiver = BurstReceiver(application, count)
+  transport, protocol = await loop.create_datagram_endpoint(lambda: receiver,
+                                                            remote_addr=(ip, port))
+  try:
+    start = loop.time()
+    for seq in range(count):
+      # Schedule each send from the start, so delays in one don't push back the rest.
+      await asyncio.sleep(start + seq*interval - loop.time())
+      transport.sendto(receiver.make_challenge(seq, loop.time()))
+    try:
+      await asyncio.wait_for(receiver.finished, start + (count-1)*interval + timeout - loop.time())
+    except asyncio.TimeoutError:
+      pass
+  finally:
+    transport.close()
+  return summarize_burst(receiver, ip, port, application, interval)
+
+
+def summarize_burst(receiver, ip, port, application, interval):
+  sent = len(receiver.sent)
+  received = len(receiver.arrivals)
+  results = {'protocol':'dns' if application == 'dns' else 'udp', 'ip':ip, 'port':port,
+             'interval':interval, 'sent':sent, 'received':received, 'lost':sent-received,
+             'wrong':receiver.wrong, 'duplicates':receiver.duplicates,
+             'loss_pct':100*(sent-received)/sent if sent else None}
+  # A reply is out of order if one for a later challenge arrived before it.
+  reordered = 0
+  highest = -1
+  for seq, rtt in receiver.arrivals:
+    if seq < highest:
+      reordered += 1
+    highest = max(highest, seq)
+  results['reordered'] = reordered
+  results['rtt_ms'] = summarize_latencies(sorted(rtt for seq, rtt in receiver.arrivals),
+                                          percentiles=BURST_PERCENTILES)
+  # Jitter: the mean difference between the round trip times of consecutive challenges which were
+  # both answered (like the RFC 3550 estimate, but without the smoothing).
+  rtts = dict(receiver.arrivals)
+  diffs = [abs(rtts[seq]-rtts[seq-1]) for seq in sorted(rtts) if seq-1 in rtts]
+  results['jitter_ms'] = sum(diffs)/len(diffs) if diffs else None
+  return results
+
+
+def format_burst_results(results):
+  lines = ['Sent {sent} {protocol} challenges to {ip} port {port}: {received} replies, {lost} lost, '
+           '{wrong} wrong, {duplicates} duplicates, {reordered} out of order.'.format(**results)]
+  if results['loss_pct'] is not None:
+    lines.append('Loss: {:0.2f}%'.format(results['loss_pct']))
+  rtt = results['rtt_ms']
+  if rtt:
+    percentiles = ['p{} {:0.2f}'.format(p, rtt['p{}'.format(p)]) for p in BURST_PERCENTILES]
+    lines.append('Round trip time (ms): min {:0.2f}, avg {:0.2f}, {}, max {:0.2f}'
+                 .format(rtt['min'], rtt['mean'], ', '.join(percentiles), rtt['max']))
+  if results['jitter_ms'] is not None:
+    lines.append('Jitter: {:0.2f} ms'.format(results['jitter_ms']))
+  return '\n'.join(lines)
+
+
+def format_burst_tsv(results):
+  """One line: sent, received, loss %, min, avg, p50, p95 and max round trip time, jitter, and the
+  number of replies out of order. Missing values are left empty."""
+  rtt = results['rtt_ms'] or {}
+  fields = [results['sent'], results['received'], results['loss_pct'], rtt.get('min'),
+            rtt.get('mean')]
+  fields += [rtt.get('p{}'.format(p)) for p in BURST_PERCENTILES]
+  fields += [rtt.get('max'), results['jitter_ms'], results['reordered']]
+  return '\t'.join('' if f is None else '{:0.2f}'.format(f) if isinstance(f, float) else str(f)
+                   for f in fields)
+
+
+class BurstReceiver(asyncio.DatagramProtocol):
+  """Make the challenges for a burst and collect the replies, in the order they arrive.
+  Each challenge starts with its sequence number, and replies are matched to challenges by their
+  digests, so even raw UDP replies can be told apart."""
+
+  def __init__(self, application, count):
+    self.application = application
+    self.count = count
+    self.sent = {}
+    self.expected = {}
+    self.arrivals = []
+    self.answered = set()
+    self.wrong = 0
+    self.duplicates = 0
+    self.finished = asyncio.get_running_loop().create_future()
+
+  def make_challenge(self, seq, now):
+    message = '{}.{}.com'.format(seq, get_rand_string(12))
+    self.expected[polo.get_hash(bytes(message, 'utf8'))] = seq
+    self.sent[seq] = now
+    if self.application == 'dns':
+      return fauxdns.encode_dns_query(message, fauxdns.int_to_bytes(seq % 2**16, fauxdns.TXN_ID_LEN))
+    else:
+      return bytes(message, 'utf8')
+
+  def datagram_received(self, data, address):
+    now = asyncio.get_running_loop().time()
+    if self.application == 'dns':
+      try:
+        txn_id, query, answer = fauxdns.split_dns_response(data)
+        digest = fauxdns.extract_dns_answer(answer)
+      except ValueError as error:
+        logging.warning('Warning: Malformed response: {}'.format(error))
+        self.wrong += 1
+        return
+    else:
+      digest = data
+    seq = self.expected.get(digest)
+    if seq is None:
+      self.wrong += 1
+      return
+    elif seq in self.answered:
+      self.duplicates += 1
+      return
+    self.answered.add(seq)
+    self.arrivals.append((seq, 1000*(now-self.sent[seq])))
+    if len(self.arrivals) == self.count and not self.finished.done():
+      self.finished.set_result(None)
+
+  def error_received(self, error):
+    logging.info('Error on burst socket: {}'.format(error))
+
+
+class UdpProber(asyncio.DatagramProtocol):
+  """A client socket for sending UDP or DNS challenges from the event loop, one at a time.
+  Use it as an async context manager, which gives a probe() coroutine. That sends one challenge and
+  returns whether the reply was correct. Replies to earlier challenges which arrive late are ignored.
+  """
+
+  def __init__(self, ip, port, application='raw'):
+    self.address = (ip, port)
+    self.application = application
+    self.transport = None
+    self.waiter = None
+    self.expected = None
+    self.txn_id = None
+
+  async def __aenter__(self):
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: self, remote_addr=self.address)
+    return self.probe
+
+  async def __aexit__(self, *exception):
+    self.transport.close()
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, address):
+    if self.waiter is None or self.waiter.done():
+      return
+    if self.application == 'raw':
+      # There's no transaction ID, so only the expected digest can tell us it's not a late reply.
+      if data == self.expected:
+        self.waiter.set_result(True)
+      return
+    try:
+      txn_id, query, answer = fauxdns.split_dns_response(data)
+      digest = fauxdns.extract_dns_answer(answer)
+    except ValueError:
+      self.waiter.set_result(False)
+      return
+    if txn_id == self.txn_id:
+      self.waiter.set_result(digest == self.expected)
+
+  def error_received(self, error):
+    if self.waiter is not None and not self.waiter.done():
+      self.waiter.set_exception(error)
+
+  async def probe(self, message):
+    self.expected = polo.get_hash(bytes(message, 'utf8'))
+    if self.application == 'dns':
+      self.txn_id = get_random_bytes(2)
+      data = fauxdns.encode_dns_query(message, self.txn_id)
+    else:
+      data = bytes(message, 'utf8')
+    self.waiter = asyncio.get_running_loop().create_future()
+    self.transport.sendto(data)
+    return await self.waiter
+
+
+class DnsProber(UdpProber):
+  def __init__(self, ip, port):
+    super().__init__(ip, port, application='dns')
+
+
+class TcpProber:
+  """Send raw TCP challenges, one connection per challenge (polo closes it after replying)."""
+
+  def __init__(self, ip, port):
+    self.address = (ip, port)
+
+  async def __aenter__(self):
+    return self.probe
+
+  async def __aexit__(self, *exception):
+    pass
+
+  async def probe(self, message):
+    reader, writer = await asyncio.open_connection(*self.address)
+    try:
+      writer.write(bytes(message+'\n', 'utf8'))
+      response = await reader.read()
+    finally:
+      writer.close()
+    return response == polo.get_hash(bytes(message, 'utf8'))
+
+
+class StreamProber:
+  """Send challenges over one long-lived TCP connection, reconnecting when needed. Subclasses define
+  exchange(), and can extend connect() to set up the connection."""
+
+  def __init__(self, ip, port):
+    self.address = (ip, port)
+    self.reader = None
+    self.writer = None
+
+  async def __aenter__(self):
+    return self.probe
+
+  async def __aexit__(self, *exception):
+    self.close()
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = None
+
+  async def connect(self):
+    return await asyncio.open_connection(*self.address)
+
+  async def probe(self, message):
+    try:
+      if self.writer is None:
+        self.reader, self.writer = await self.connect()
+      return await self.exchange(message)
+    except BaseException:
+      # We don't know what state the connection is in anymore.
+      self.close()
+      raise
+
+
+class HttpProber(StreamProber):
+  """Send HTTP polo challenges over one keep-alive connection, reconnecting when needed."""
+
+  def __init__(self, ip, port, host=None):
+    super().__init__(ip, port)
+    self.host = host or ip
+
+  async def exchange(self, message):
+    self.writer.write(format_http_request(message, self.host))
+    head = await self.reader.readuntil(b'\r\n\r\n')
+    status, headers = parse_http_response_head(head)
+    body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+    if headers.get('connection', '').lower() == 'close':
+      self.close()
+    return get_http_digest(status, body) == polo.get_hash(bytes(message, 'utf8'))
+
+
+def format_http_request(message, host, keep_alive=True):
+  """Make a GET request carrying the challenge "message"."""
+  query = urllib.parse.urlencode({'challenge':message})
+  request = ('GET {}?{} HTTP/1.1\r\nHost: {}\r\nCache-Control: no-cache\r\n'
+             .format(polo.HTTP_PATH, query, host))
+  if not keep_alive:
+    request += 'Connection: close\r\n'
+  return bytes(request+'\r\n', 'utf8')
+
+
+def get_http_digest(status, body):
+  """Get the digest from the body of a polo HTTP response, or None if it isn't one."""
+  if status != 200:
+    return None
+  try:
+    return bytes.fromhex(json.loads(str(body, 'utf8'))['digest'])
+  except (ValueError, KeyError, TypeError):
+    return None
+
+
+def parse_http_response_head(head):
+  """Parse the status line and headers of an HTTP response.
+  Returns the status code and a dict of headers with lowercased names. Raises ValueError if it's
+  malformed."""
+  lines = str(head, 'iso-8859-1').split('\r\n')
+  fields = lines[0].split(None, 2)
+  if len(fields) < 2 or not fields[0].startswith('HTTP/'):
+    raise ValueError('Malformed status line: {!r}'.format(lines[0]))
+  status = int(fields[1])
+  headers = {}
+  for line in lines[1:]:
+    name, colon, value = line.partition(':')
+    if colon:
+      headers[name.strip().lower()] = value.strip()
+  return status, headers
+
+
+class DnsTcpProber:
+  """Send DNS challenges over one TCP connection, reconnecting when needed. Responses are matched
+  to queries by transaction ID, so several probes can share the connection at once."""
+
+  def __init__(self, ip, port):
+    self.address = (ip, port)
+    self.reader = None
+    self.writer = None
+    self.receiver = None
+    self.pending = {}
+
+  async def __aenter__(self):
+    return self.probe
+
+  async def __aexit__(self, *exception):
+    if self.receiver is not None:
+      self.receiver.cancel()
+    self.close(ConnectionError('Prober closed.'))
+
+  def close(self, error):
+    """Close the connection and fail any probes still waiting on it with "error"."""
+    if self.writer is not None:
+      self.writer.close()
+    self.reader = self.writer = self.receiver = None
+    for waiter, expected in self.pending.values():
+      if not waiter.done():
+        waiter.set_exception(error)
+    self.pending = {}
+
+  async def probe(self, message):
+    if self.writer is None:
+      self.reader, self.writer = await asyncio.open_connection(*self.address)
+      self.receiver = asyncio.ensure_future(self.receive(self.reader))
+    txn_id = get_random_bytes(fauxdns.TXN_ID_LEN)
+    while txn_id in self.pending:
+      txn_id = get_random_bytes(fauxdns.TXN_ID_LEN)
+    waiter = asyncio.get_running_loop().create_future()
+    self.pending[txn_id] = (waiter, polo.get_hash(bytes(message, 'utf8')))
+    try:
+      self.writer.write(fauxdns.frame_tcp(fauxdns.encode_dns_query(message, txn_id)))
+      return await waiter
+    finally:
+      self.pending.pop(txn_id, None)
+
+  async def receive(self, reader):
+    """Read responses and hand each to the probe waiting on its transaction ID."""
+    try:
+      while True:
+        prefix = await reader.readexactly(fauxdns.TCP_LENGTH.size)
+        length, = fauxdns.TCP_LENGTH.unpack(prefix)
+        packet = await reader.readexactly(length)
+        try:
+          txn_id, query, answer = fauxdns.split_dns_response(packet)
+          digest = fauxdns.extract_dns_answer(answer)
+        except ValueError:
+          txn_id = packet[:fauxdns.TXN_ID_LEN]
+          digest = None
+        waiter, expected = self.pending.get(txn_id, (None, None))
+        if waiter is not None and not waiter.done():
+          waiter.set_result(digest == expected)
+    except (OSError, asyncio.IncompleteReadError) as error:
+      # Probably polo closing an idle connection. The next probe will reconnect.
+      if reader is self.reader:
+        self.close(error)
+
+
+class TcpSessionProber(StreamProber):
+  """Send raw TCP challenges over one polo session, reconnecting when needed."""
+
+  async def connect(self):
+    reader, writer = await super().connect()
+    # Only hand over the connection once the session is acknowledged, so a failed handshake can't
+    # leave its ack to be misread as a reply.
+    try:
+      writer.write(polo.SESSION_GREETING)
+      ack = await reader.readline()
+      if ack != polo.SESSION_ACK:
+        raise ConnectionError('Server didn\'t start a session (it replied {!r}).'.format(ack))
+    except BaseException:
+      writer.close()
+      raise
+    return reader, writer
+
+  async def exchange(self, message):
+    self.writer.write(bytes(message+'\n', 'utf8'))
+    prefix = await self.reader.readexactly(polo.SESSION_LENGTH.size)
+    length, = polo.SESSION_LENGTH.unpack(prefix)
+    digest = await self.reader.readexactly(length)
+    return digest == polo.get_hash(bytes(message, 'utf8'))
+
+
+PROBERS = {'udp':UdpProber, 'dns':DnsProber, 'tcp':TcpProber, 'http':HttpProber,
+           'dns-tcp':DnsTcpProber, 'tcp-session':TcpSessionProber}
 
 
 def get_random_bytes(length):
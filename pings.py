@@ -7,13 +7,18 @@ import re
 import sys
 import json
 import random
+import select
 import socket
 import string
+import struct
 import timeit
 import hashlib
 import httplib
 import binascii
+import threading
 import subprocess
+import collections
+import happyeyeballs
 try:
   import dns.resolver
   import dns.exception
@@ -29,6 +34,32 @@ else:
 # These headers might take care of hotspot caches.
 HTTP_HEADERS = {'Cache-Control':'no-cache', 'Pragma':'no-cache'}
 HASH_CONST = b'Bust those caches!'
+# The phases of an HTTP ping which ping_http() times (see its docstring).
+TIMINGS = ('dns', 'connect', 'ttfb', 'transfer')
+# Linux's struct tcp_info: 8 one-byte fields (including tcpi_retransmits at index 2), then 24
+# 32-bit ones, starting with tcpi_rto. Newer kernels append more fields, which aren't needed.
+TCP_INFO = struct.Struct(str('=8B24I'))
+TCP_INFO_FIELDS = {'lost':14, 'rtt':23, 'rttvar':24, 'total_retrans':31}
+# The connection statistics which PersistentProbe reports (see its docstring).
+TCP_STATS = ('srtt', 'rttvar', 'retransmits', 'lost')
+# ICMP message types for echo requests and replies, in ICMP and ICMPv6.
+ICMP_ECHO_TYPES = {socket.AF_INET:(8, 0), socket.AF_INET6:(128, 129)}
+# The ICMP echo header: type, code, checksum, identifier, and sequence number.
+ICMP_HEADER = struct.Struct(str('!BBHHH'))
+ICMP_PAYLOAD_LEN = 16
+# Seconds to cache DNS answers when the resolver doesn't give their TTL.
+DNS_DEFAULT_TTL = 60
+# Seconds to remember that a name doesn't exist.
+DNS_NEGATIVE_TTL = 30
+# The address families resolve() looks up by default, in the order its answers list them. With
+# dnspython that order is fixed, so IPv6 always gets the head start in connect_happy_eyeballs(), as
+# RFC 8305 recommends, and the system's own preference (gai.conf) is ignored. Without dnspython,
+# getaddrinfo() orders the answers, so that preference applies.
+DNS_FAMILIES = (socket.AF_INET6, socket.AF_INET)
+DNS_RDTYPES = {socket.AF_INET:'A', socket.AF_INET6:'AAAA'}
+# getaddrinfo() errors which mean the name has no addresses, rather than that the lookup failed.
+NEGATIVE_GAI_ERRORS = {getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA')
+                       if hasattr(socket, name)}
 
 
 def get_ping_version():
@@ -64,15 +95,24 @@ def get_ping_version():
     return output_lines[0]
 
 
-def ping(server, method='ping', timeout=2, ping_ver=None):
+def ping(server, method='ping', timeout=2, ping_ver=None, pinger=None):
   """Ping "server", and return the ping time in milliseconds.
   If the ping fails, returns 0.
   If the method is "curl", the returned time is the "time_connect" variable of
   curl's "-w" option (multiplied by 1000 to get ms). In practice the time is
-  very similar to a simple ping."""
+  very similar to a simple ping.
+  If the method is "icmp", the ping is sent from this process instead of by the
+  ping command. Give an IcmpPinger as "pinger" to reuse its socket.
+  The "connect" and "head" methods time the TCP handshake to port 80 from this
+  process, like "curl" without running a command. "head" also sends a HEAD
+  request, and fails unless an HTTP response comes back, as curl does."""
+  assert method in ['ping', 'curl', 'icmp', 'connect', 'head'], 'Error: Invalid ping method'
+  if method == 'icmp':
+    return ping_icmp(server, timeout=timeout, pinger=pinger)
+  elif method in ('connect', 'head'):
+    return ping_connect(server, timeout=timeout, head=method == 'head')
   devnull = open(os.devnull, 'w')
   # Build command.
-  assert method in ['ping', 'curl'], 'Error: Invalid ping method'
   if method == 'ping':
     # Timeout depends on which version of ping. If it can't be determined, don't set timeout.
     if ping_ver == 'iputils':
@@ -106,6 +146,159 @@ def ping(server, method='ping', timeout=2, ping_ver=None):
     return 0.0
 
 
+def ping_icmp(server, timeout=2, pinger=None):
+  """Send one ICMP echo request to "server" and return the round trip time in
+  milliseconds, or 0.0 on failure."""
+  ip = dns_lookup(server, timeout=timeout)
+  if ip is None:
+    return 0.0
+  close = False
+  try:
+    if pinger is None:
+      pinger = IcmpPinger()
+      close = True
+    return pinger.ping(ip, timeout=timeout)
+  except socket.error:
+    return 0.0
+  finally:
+    if close:
+      pinger.close()
+
+
+class IcmpPinger(object):
+  """Send ICMP echo requests and match up the replies, all from one socket, which
+  can be reused for any number of pings. Uses an unprivileged "ping socket"
+  (SOCK_DGRAM with IPPROTO_ICMP) if the system allows it (on Linux, see the
+  net.ipv4.ping_group_range sysctl), or else a raw socket, which needs root.
+  Raises socket.error if neither can be opened."""
+
+  def __init__(self, family=socket.AF_INET):
+    self.family = family
+    if family == socket.AF_INET6:
+      proto = socket.IPPROTO_ICMPV6
+    else:
+      proto = socket.IPPROTO_ICMP
+    try:
+      self.sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+      self.raw = False
+    except socket.error:
+      self.sock = socket.socket(family, socket.SOCK_RAW, proto)
+      self.raw = True
+    # Ping sockets replace the identifier with their own, and only get replies
+    # matching it. Raw sockets get every ICMP packet, so the identifier is how
+    # we tell ours from those of other processes.
+    self.ident = os.getpid() & 0xffff
+    self.seq = random.randint(0, 0xffff)
+    self.request_type, self.reply_type = ICMP_ECHO_TYPES[family]
+    # Map each sequence number in flight to its payload and send time.
+    self.pending = {}
+
+  def close(self):
+    self.sock.close()
+
+  def send(self, ip):
+    """Send an echo request to "ip" without waiting for the reply. Returns its
+    sequence number, to give to wait()."""
+    self.seq = (self.seq + 1) & 0xffff
+    payload = os.urandom(ICMP_PAYLOAD_LEN)
+    header = ICMP_HEADER.pack(self.request_type, 0, 0, self.ident, self.seq)
+    checksum = get_checksum(header+payload)
+    packet = ICMP_HEADER.pack(self.request_type, 0, checksum, self.ident, self.seq) + payload
+    self.pending[self.seq] = (payload, timeit.default_timer())
+    self.sock.sendto(packet, (ip, 0))
+    return self.seq
+
+  def wait(self, seqs, timeout=2):
+    """Wait up to "timeout" seconds for the replies to the requests with the
+    sequence numbers "seqs". Returns a dict mapping each sequence number to its
+    round trip time in milliseconds, or 0.0 if no reply came."""
+    rtts = dict((seq, 0.0) for seq in seqs)
+    waiting = set(seqs)
+    deadline = timeit.default_timer() + timeout
+    try:
+      while waiting:
+        remaining = deadline - timeit.default_timer()
+        if remaining <= 0:
+          break
+        readable, writable, exceptional = select.select([self.sock], [], [], remaining)
+        if not readable:
+          break
+        packet = self.sock.recv(2048)
+        received = timeit.default_timer()
+        seq = self.parse_reply(packet)
+        if seq in waiting:
+          payload, sent = self.pending[seq]
+          rtts[seq] = round(1000 * (received - sent), 3)
+          waiting.discard(seq)
+    finally:
+      for seq in seqs:
+        self.pending.pop(seq, None)
+    return rtts
+
+  def ping(self, ip, timeout=2):
+    """Ping "ip" and return the round trip time in milliseconds, or 0.0 if no
+    reply came within "timeout" seconds."""
+    seq = self.send(ip)
+    return self.wait([seq], timeout=timeout)[seq]
+
+  def parse_reply(self, packet):
+    """Return the sequence number of an echo reply to one of our requests, or
+    None if it's any other packet."""
+    if self.raw and self.family == socket.AF_INET:
+      # Raw IPv4 sockets include the IP header.
+      packet = packet[(ord(packet[0:1]) & 0x0f) * 4:]
+    if len(packet) < ICMP_HEADER.size + ICMP_PAYLOAD_LEN:
+      return None
+    msg_type, code, checksum, ident, seq = ICMP_HEADER.unpack_from(packet)
+    if msg_type != self.reply_type or (self.raw and ident != self.ident):
+      return None
+    if seq not in self.pending:
+      return None
+    payload, sent = self.pending[seq]
+    if packet[ICMP_HEADER.size:] != payload:
+      return None
+    return seq
+
+
+def get_checksum(data):
+  """Compute the internet checksum (RFC 1071) of "data"."""
+  if len(data) % 2:
+    data += b'\0'
+  total = sum(struct.unpack(str('!{}H').format(len(data)//2), data))
+  total = (total >> 16) + (total & 0xffff)
+  total += total >> 16
+  return ~total & 0xffff
+
+
+def ping_connect(server, port=80, timeout=2, head=False, details=None):
+  """Time the TCP handshake with "server" and return it in milliseconds, or 0.0
+  on failure. If "head" is true, also send a HEAD request for "/", and return
+  0.0 unless an HTTP response comes back (whatever its status).
+  See ping_http() for "details"."""
+  addresses = dns_lookup_addresses(server, port=port, timeout=timeout)
+  if not addresses:
+    return 0.0
+  try:
+    sock, sockaddr, seconds = happyeyeballs.connect_happy_eyeballs(addresses, timeout=timeout)
+  except socket.error:
+    return 0.0
+  try:
+    if details is not None:
+      details['address'] = sockaddr[0]
+      details['family'] = happyeyeballs.FAMILY_NAMES.get(sock.family)
+    if head:
+      sock.settimeout(timeout)
+      request = 'HEAD / HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(server)
+      sock.sendall(request.encode('ascii'))
+      if not sock.recv(1024).startswith(b'HTTP/'):
+        return 0.0
+  except socket.error:
+    return 0.0
+  finally:
+    sock.close()
+  return round(1000 * seconds, 3)
+
+
 def parse_ping(ping_str):
   """Parse out the ms of the ping from the output of `ping -n -c 1`"""
   ping_pattern = r' bytes from .* time=([\d.]+) ?ms'
@@ -127,7 +320,8 @@ def parse_curl(curl_str):
     return 0.0
 
 
-def ping_and_check(timeout=2, server='www.gstatic.com', path='/generate_204', status=204, body=''):
+def ping_and_check(timeout=2, server='www.gstatic.com', path='/generate_204', status=204, body='',
+                   details=None):
   """"Ping" a server with an HTTP GET request, returning the latency and whether
   the response appears to be intercepted (i.e. by a captive portal).
   By default, uses http://www.gstatic.com/generate_204 and assumes interception
@@ -137,51 +331,248 @@ def ping_and_check(timeout=2, server='www.gstatic.com', path='/generate_204', st
   round trip.
   Returns (float, bool): latency in milliseconds and whether the response looks
   intercepted. If no connection can be established, returns (0.0, None). If an
-  error is encountered at any point, returns None for the second value."""
-  elapsed, response = ping_http(timeout=timeout, server=server, path=path)
+  error is encountered at any point, returns None for the second value.
+  See ping_http() for "details", which includes the timing of each phase."""
+  elapsed, response = ping_http(timeout=timeout, server=server, path=path, details=details)
   if response is None:
     return 0.0, None
-  # Is the response as expected?
-  # If only an expected status is given (body is None), only that has to match.
-  # If a status and body is given, both have to match.
-  if response['status'] == status and (body is None or response['body'] == body):
-    expected = True
-  else:
-    expected = False
-  return elapsed, not expected
+  return elapsed, not check_response(response, status=status, body=body)
+
+
+def check_response(response, status=204, body=''):
+  """Is the response as expected?
+  If only an expected status is given (body is None), only that has to match.
+  If a status and body is given, both have to match."""
+  return response['status'] == status and (body is None or response['body'] == body)
 
 
 def ping_with_challenge(server='polo.nstoler.com', path='/uptest/polo', status=200, timeout=2,
-                        **kwargs):
+                        details=None, **kwargs):
   """"Ping" a server with the HTTP polo protocol, issuing a challenge and checking the result.
   Returns the latency of the connection, measured by the time taken for the TCP handshake, and
   whether the connection looks intercepted. So it will give False if the server passed the challenge
   and True if it made a connection, but the response wasn't correct. None means it was unable to
-  make a connection (through timeout or error)."""
+  make a connection (through timeout or error). See ping_http() for "details"."""
   challenge = get_rand_string(16)
+  elapsed, response = ping_http(server=server, path=add_challenge(path, challenge),
+                                timeout=timeout, details=details)
+  if response is None:
+    return 0.0, None
+  return elapsed, not check_challenge(response, challenge, status=status)
+
+
+def add_challenge(path, challenge):
   params = {'challenge':challenge}
   if PY3:
-    path += '?'+urllib.parse.urlencode(params)
+    return path+'?'+urllib.parse.urlencode(params)
   else:
-    path += '?'+urllib.urlencode(params)
-  elapsed, response = ping_http(server=server, path=path, timeout=timeout)
-  expected_digest = get_hash(bytes(challenge))
-  if response is None:
-    return 0.0, None
+    return path+'?'+urllib.urlencode(params)
+
+
+def check_challenge(response, challenge, status=200):
+  """Did the server pass the challenge?"""
   if response['status'] != status:
-    return elapsed, True
+    return False
   try:
     response_data = json.loads(response['body'])
   except ValueError:
-    return elapsed, True
+    return False
   try:
     response_digest = binascii.unhexlify(response_data.get('digest'))
   except TypeError:
-    return elapsed, True
-  if response_digest == expected_digest:
-    return elapsed, False
-  else:
-    return elapsed, True
+    return False
+  return response_digest == get_hash(bytes(challenge))
+
+
+class PersistentProbe(object):
+  """Ping an HTTP server over one long-lived connection, instead of a new one each time. Each
+  probe() makes the same request as ping_and_check() (or ping_with_challenge(), if "challenge" is
+  true), then reads the kernel's statistics for the connection (TCP_INFO, so Linux only). Its
+  smoothed round trip time is reported as the latency, which, unlike a single handshake, reflects
+  every packet exchanged since the connection opened. If the server closes the connection, the
+  next probe opens a new one."""
+
+  def __init__(self, server='www.gstatic.com', path='/generate_204', status=204, body='',
+               timeout=2, challenge=False):
+    self.server = server
+    self.path = path
+    self.status = status
+    self.body = body
+    self.timeout = timeout
+    self.challenge = challenge
+    self.challenge_str = None
+    self.conex = None
+    self.sock = None
+    self.total_retrans = 0
+
+  def close(self):
+    if self.conex is not None:
+      self.conex.close()
+      self.sock.close()
+      self.conex = None
+      self.sock = None
+
+  def connect(self, timings):
+    start = timeit.default_timer()
+    addresses = dns_lookup_addresses(self.server, timeout=self.timeout)
+    timings['dns'] = round(1000 * (timeit.default_timer() - start), 1)
+    if not addresses:
+      raise socket.error('Could not resolve {}'.format(self.server))
+    sock, sockaddr, seconds = happyeyeballs.connect_happy_eyeballs(addresses, timeout=self.timeout)
+    timings['connect'] = round(1000 * seconds, 1)
+    sock.settimeout(self.timeout)
+    self.conex = httplib.HTTPConnection(self.server, timeout=self.timeout)
+    self.conex.sock = sock
+    # httplib closes its socket as soon as a response says the connection will close, so keep a
+    # duplicate to read the statistics from.
+    self.sock = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    self.total_retrans = 0
+
+  def probe(self, details=None):
+    """Returns (latency, intercepted) like ping_and_check(). If a dict is given as "details", it
+    gets the "address", "family" and "timings" described in ping_http() ("dns" and "connect" only
+    when a new connection was needed), "reused" (whether the connection was), and "tcp_info": the
+    connection statistics named in TCP_STATS. "srtt" and "rttvar" are the smoothed round trip time
+    and its variance in milliseconds, "retransmits" is the number of segments retransmitted since
+    the last probe, and "lost" is the number the kernel currently thinks are lost."""
+    if details is None:
+      details = {}
+    details['timings'] = timings = {}
+    details['reused'] = self.conex is not None
+    try:
+      try:
+        response = self.request(timings)
+      except (httplib.HTTPException, socket.error):
+        if not details['reused']:
+          raise
+        # The server probably closed the idle connection. Try once more, on a fresh one.
+        self.close()
+        details['reused'] = False
+        details['timings'] = timings = {}
+        response = self.request(timings)
+      details['address'] = self.sock.getpeername()[0]
+      details['family'] = happyeyeballs.FAMILY_NAMES.get(self.sock.family)
+      details['tcp_info'] = tcp_info = self.get_tcp_info()
+    except (httplib.HTTPException, socket.error):
+      self.close()
+      return 0.0, None
+    finally:
+      if self.conex is not None and self.conex.sock is None:
+        # The server asked to close the connection.
+        self.close()
+    if self.challenge:
+      intercepted = not check_challenge(response, self.challenge_str, status=self.status)
+    else:
+      intercepted = not check_response(response, status=self.status, body=self.body)
+    return tcp_info['srtt'], intercepted
+
+  def request(self, timings):
+    if self.conex is None:
+      self.connect(timings)
+    path = self.path
+    if self.challenge:
+      self.challenge_str = get_rand_string(16)
+      path = add_challenge(path, self.challenge_str)
+    headers = HTTP_HEADERS.copy()
+    headers['Host'] = self.server
+    start = timeit.default_timer()
+    self.conex.request('GET', path, None, headers)
+    response = self.conex.getresponse()
+    timings['ttfb'] = round(1000 * (timeit.default_timer() - start), 1)
+    start = timeit.default_timer()
+    # Read the whole body, or the connection can't be reused.
+    body = response.read()
+    timings['transfer'] = round(1000 * (timeit.default_timer() - start), 1)
+    return {'status':response.status, 'body':body[:1024]}
+
+  def get_tcp_info(self):
+    """Read TCP_INFO for the connection. Returns a dict of the values named in TCP_STATS."""
+    data = self.sock.getsockopt(socket.IPPROTO_TCP, getattr(socket, 'TCP_INFO', 11), TCP_INFO.size)
+    fields = TCP_INFO.unpack(data[:TCP_INFO.size])
+    total_retrans = fields[TCP_INFO_FIELDS['total_retrans']]
+    retransmits = total_retrans - self.total_retrans
+    self.total_retrans = total_retrans
+    # The kernel gives the round trip times in microseconds.
+    return {'srtt':fields[TCP_INFO_FIELDS['rtt']] / 1000,
+            'rttvar':fields[TCP_INFO_FIELDS['rttvar']] / 1000,
+            'retransmits':retransmits, 'lost':fields[TCP_INFO_FIELDS['lost']]}
+
+
+class PingRace(object):
+  """Run several HTTP pings at once, in parallel threads, to get a verdict from the first of them
+  to agree. "probes" is a dict mapping names to functions which take a "details" dict and return
+  (latency, intercepted), like ping_and_check(). As each one finishes, its result is stored in
+  "results", a dict mapping its name to (latency, intercepted, details)."""
+
+  def __init__(self, probes):
+    self.probes = probes
+    self.results = {}
+    self.condition = threading.Condition()
+    self.threads = []
+
+  def start(self):
+    for name, probe in self.probes.items():
+      thread = threading.Thread(target=self.run, args=(name, probe))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def run(self, name, probe):
+    details = {}
+    latency, intercepted = 0.0, None
+    try:
+      latency, intercepted = probe(details)
+    finally:
+      with self.condition:
+        self.results[name] = (latency, intercepted, details)
+        self.condition.notify_all()
+
+  def wait(self, quorum, timeout=None):
+    """Wait until "quorum" of the results agree on "intercepted", all of them are in, or "timeout"
+    seconds pass. Failures (None) don't count toward a quorum, so a few quick failures can't
+    outvote slower pings which go on to succeed. Returns (latency, intercepted) like
+    ping_and_check(), where the latency is the fastest of the results in agreement. Without a
+    quorum, it assumes the worst of the results which are in: intercepted (True) if any are,
+    otherwise failed (None) if any did."""
+    if timeout is not None:
+      deadline = timeit.default_timer() + timeout
+    with self.condition:
+      while True:
+        counts = collections.Counter(result[1] for result in self.results.values())
+        agreed = [value for value, count in counts.items()
+                  if value is not None and count >= quorum]
+        if agreed:
+          verdict = agreed[0]
+          break
+        if len(self.results) >= len(self.probes):
+          remaining = 0
+        elif timeout is None:
+          remaining = None
+        else:
+          remaining = deadline - timeit.default_timer()
+        if remaining is not None and remaining <= 0:
+          verdict = None
+          for value in (True, None, False):
+            if value in counts:
+              verdict = value
+              break
+          break
+        self.condition.wait(remaining)
+      latencies = [result[0] for result in self.results.values()
+                   if result[1] == verdict and result[0]]
+    if latencies:
+      return min(latencies), verdict
+    else:
+      return 0.0, None
+
+  def join(self, timeout=None):
+    """Wait for all the pings to finish, up to "timeout" seconds in total."""
+    start = timeit.default_timer()
+    for thread in self.threads:
+      if timeout is None:
+        thread.join()
+      else:
+        thread.join(max(start + timeout - timeit.default_timer(), 0))
 
 
 def get_hash(data, algorithm='sha256', hash_const=HASH_CONST):
@@ -190,24 +581,43 @@ def get_hash(data, algorithm='sha256', hash_const=HASH_CONST):
   return hasher.digest()
 
 
-def ping_http(timeout=2, server='www.gstatic.com', path='/generate_204', buffer=1024, post_data=None):
+def ping_http(timeout=2, server='www.gstatic.com', path='/generate_204', buffer=1024, post_data=None,
+              details=None):
+  """Make an HTTP request to "server", connecting to whichever of its IPv4 and IPv6 addresses
+  answers first. Returns the milliseconds taken by the TCP handshake and a dict with the "status"
+  and "body" of the response, or (0.0, None) on failure. If a dict is given as "details", the
+  "address" and "family" ("IPv4" or "IPv6") connected to are stored in it, along with "timings": a
+  dict of the milliseconds taken by each phase of the request, named in TIMINGS. "dns" is the
+  lookup (near 0 when cached), "connect" is the TCP handshake (the same as the returned latency),
+  "ttfb" is from sending the request to receiving the status line and headers, and "transfer" is
+  reading the body. If the request fails partway through, only the phases which finished are
+  included."""
+  timings = {}
+  if details is not None:
+    details['timings'] = timings
   # Do the DNS lookup outside the timed portion of the connection, where we only want to measure the
   # TCP handshake, not any needed DNS lookup.
-  ip = dns_lookup(server, timeout=timeout)
-  if ip is None:
+  start = timeit.default_timer()
+  addresses = dns_lookup_addresses(server, timeout=timeout)
+  timings['dns'] = round(1000 * (timeit.default_timer() - start), 1)
+  if not addresses:
     return 0.0, None
-  # Create the connection object.
-  conex = httplib.HTTPConnection(ip, timeout=timeout)
-  # Open a connection to the server. connect() just establishes the TCP connection with a
-  # SYN, SYN/ACK, ACK handshake, returning after the final ACK is sent. This is essentially
-  # immediately after the SYN/ACK arrives, making it a good measure of a single round trip.
-  before = timeit.default_timer()
+  # Establish the TCP connection with a SYN, SYN/ACK, ACK handshake. The connection is done right
+  # after the final ACK is sent. This is essentially immediately after the SYN/ACK arrives, making
+  # it a good measure of a single round trip.
   try:
-    conex.connect()
-  except (httplib.HTTPException, socket.error):
+    sock, sockaddr, seconds = happyeyeballs.connect_happy_eyeballs(addresses, timeout=timeout)
+  except socket.error:
     return 0.0, None
-  after = timeit.default_timer()
-  elapsed = round(1000 * (after - before), 1)
+  elapsed = round(1000 * seconds, 1)
+  timings['connect'] = elapsed
+  if details is not None:
+    details['address'] = sockaddr[0]
+    details['family'] = happyeyeballs.FAMILY_NAMES.get(sock.family)
+  sock.settimeout(timeout)
+  # Create the connection object, handing it the already-connected socket.
+  conex = httplib.HTTPConnection(server, timeout=timeout)
+  conex.sock = sock
   # Make the HTTP request.
   # We have to define the Host header explicitly to avoid it appearing as the IP address.
   # Note: This won't work with HTTPS, since the host will be passed in the SNI.
@@ -220,6 +630,7 @@ def ping_http(timeout=2, server='www.gstatic.com', path='/generate_204', buffer=
   else:
     method = 'GET'
     params = None
+  start = timeit.default_timer()
   try:
     conex.request(method, path, params, headers)
   except (httplib.HTTPException, socket.error):
@@ -229,50 +640,184 @@ def ping_http(timeout=2, server='www.gstatic.com', path='/generate_204', buffer=
     response = conex.getresponse()
   except (httplib.HTTPException, socket.error):
     return 0.0, None
+  timings['ttfb'] = round(1000 * (timeit.default_timer() - start), 1)
   # We have to pass back a dict of response values instead of the response itself because you can't
   # read the response body after the connection is closed.
-  response_dict = {'status':response.status, 'body':response.read(buffer)}
+  start = timeit.default_timer()
+  try:
+    response_dict = {'status':response.status, 'body':response.read(buffer)}
+  except (httplib.HTTPException, socket.error):
+    return 0.0, None
+  timings['transfer'] = round(1000 * (timeit.default_timer() - start), 1)
   conex.close()
   return elapsed, response_dict
 
 
-def dns_lookup(domain, timeout=2):
-  """Do a DNS lookup with a certain timeout, if possible."""
+def dns_lookup(domain, timeout=2, cache=None):
+  """Look up an IPv4 address for "domain", within "timeout" seconds. Returns None on timeout or
+  error. Answers are cached (see DnsCache)."""
+  for family, ip in resolve(domain, timeout=timeout, cache=cache, families=(socket.AF_INET,)):
+    return ip
+  return None
+
+
+def dns_lookup_addresses(domain, port=80, timeout=2, cache=None):
+  """Look up all the IPv4 and IPv6 addresses of "domain". Returns a list of (family, sockaddr)
+  tuples, ordered by happyeyeballs.interleave_addresses(), starting with the family resolve() lists
+  first (see DNS_FAMILIES). Returns an empty list on error."""
+  addrinfo = []
+  for family, ip in resolve(domain, timeout=timeout, cache=cache):
+    if family == socket.AF_INET6:
+      sockaddr = (ip, port, 0, 0)
+    else:
+      sockaddr = (ip, port)
+    addrinfo.append((family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr))
+  return happyeyeballs.interleave_addresses(addrinfo)
+
+
+class DnsCache(object):
+  """Remember DNS answers for as long as their TTL says, so each ping doesn't wait on a lookup.
+  Names which don't exist are remembered for DNS_NEGATIVE_TTL seconds. Lookups which fail some
+  other way (like a timeout) aren't cached. If "refresh_every" is N, every Nth lookup of a name
+  skips the cache, so the health of DNS itself is still sampled. Also holds the one dnspython
+  resolver, so it doesn't re-read resolv.conf on every lookup."""
+
+  def __init__(self, refresh_every=0):
+    self.refresh_every = refresh_every
+    self.entries = {}
+    self.lookups = collections.Counter()
+    self.lock = threading.Lock()
+    self._resolver = None
+
+  @property
+  def resolver(self):
+    """The shared dns.resolver.Resolver. Raises NameError if dnspython isn't installed."""
+    if self._resolver is None:
+      self._resolver = dns.resolver.Resolver()
+    return self._resolver
+
+  def get(self, key):
+    """Return the cached list of (family, ip) tuples for "key" (a domain and the families looked
+    up), or None if there's no current answer or it's time for a fresh lookup."""
+    with self.lock:
+      self.lookups[key] += 1
+      if self.refresh_every and self.lookups[key] % self.refresh_every == 0:
+        return None
+      try:
+        expiration, addresses = self.entries[key]
+      except KeyError:
+        return None
+      if timeit.default_timer() >= expiration:
+        del self.entries[key]
+        return None
+      return addresses
+
+  def put(self, key, addresses, ttl):
+    with self.lock:
+      self.entries[key] = (timeit.default_timer() + ttl, addresses)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+
+DNS_CACHE = DnsCache()
+
+
+def resolve(domain, timeout=2, cache=None, families=DNS_FAMILIES):
+  """Look up the addresses of "domain" in each of "families", taking no more than "timeout"
+  seconds. Uses the dnspython module if it's installed, or socket.getaddrinfo() otherwise. Returns a
+  list of (family, ip) tuples, which is empty on error. "cache" defaults to DNS_CACHE."""
+  if cache is None:
+    cache = DNS_CACHE
+  key = (domain, families)
+  addresses = cache.get(key)
+  if addresses is not None:
+    return addresses
   try:
     # Try using dns.resolver, if it's installed.
-    return dns_lookup_dns(domain, timeout=timeout)
+    result = resolve_dns(domain, cache.resolver, timeout=timeout, families=families)
   except NameError:
-    # Otherwise, fall back to socket.gethostbyname().
-    return dns_lookup_socket(domain)
+    result = resolve_socket(domain, timeout=timeout, families=families)
+  if result is None:
+    return []
+  addresses, ttl = result
+  cache.put(key, addresses, ttl)
+  return addresses
 
 
-def dns_lookup_dns(domain, timeout=2):
-  """Use "dns" module to look up an IP address, returning in a specified amount of time.
-  Returns None on timeout or error."""
-  resolver = dns.resolver.Resolver()
-  resolver.timeout = timeout
-  resolver.lifetime = timeout
-  try:
-    results = resolver.query(domain)
-  except dns.exception.DNSException:
-    return None
-  try:
-    # Just pick the first IP address returned.
-    return str(results[0])
-  except IndexError:
+def resolve_dns(domain, resolver, timeout=2, families=DNS_FAMILIES):
+  """Use the "dns" module to look up the addresses of each of "families". The queries run at once,
+  in parallel threads, each with the whole "timeout", so one that times out or fails doesn't stop
+  the others from answering.
+  Returns a list of (family, ip) tuples and the lowest TTL of the answers, or None if there were no
+  addresses and any query timed out or failed."""
+  outcomes = {}
+  def query(family):
+    try:
+      outcomes[family] = resolver.query(domain, DNS_RDTYPES[family], lifetime=timeout)
+    except dns.exception.DNSException as error:
+      outcomes[family] = error
+  threads = [threading.Thread(target=query, args=(family,)) for family in families]
+  deadline = timeit.default_timer() + timeout
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join(max(deadline - timeit.default_timer(), 0))
+  addresses = []
+  ttls = []
+  failed = nxdomain = False
+  for family in families:
+    outcome = outcomes.get(family)
+    if isinstance(outcome, dns.resolver.NXDOMAIN):
+      nxdomain = True
+    elif isinstance(outcome, dns.resolver.NoAnswer):
+      continue
+    elif outcome is None or isinstance(outcome, dns.exception.DNSException):
+      failed = True
+    else:
+      ttls.append(outcome.rrset.ttl)
+      for result in outcome:
+        addresses.append((family, str(result)))
+  if addresses:
+    return addresses, min(ttls)
+  elif failed and not nxdomain:
     return None
+  else:
+    return addresses, DNS_NEGATIVE_TTL
 
 
-def dns_lookup_socket(domain):
-  """Use socket.gethostbyname() to look up an IP address.
-  Returns None on error."""
-  #TODO: Set timeout using signal.alarm():
-  #      https://stackoverflow.com/questions/492519/timeout-on-a-python-function-call/494273#494273
-  try:
-    ip = socket.gethostbyname(domain)
-  except (socket.timeout, socket.gaierror):
+def resolve_socket(domain, timeout=2, families=DNS_FAMILIES):
+  """Use socket.getaddrinfo() to look up the addresses of each of "families". It has no timeout of
+  its own, so it's run in a separate thread, which is abandoned if it takes over "timeout" seconds.
+  The addresses are in the order getaddrinfo() prefers.
+  Returns a list of (family, ip) tuples and DNS_DEFAULT_TTL (the real TTL isn't available), or None
+  on timeout or error."""
+  if len(families) == 1:
+    family_query = families[0]
+  else:
+    family_query = socket.AF_UNSPEC
+  result = {}
+  def lookup():
+    try:
+      result['addrinfo'] = socket.getaddrinfo(domain, None, family_query, socket.SOCK_STREAM)
+    except socket.gaierror as error:
+      result['error'] = error
+  thread = threading.Thread(target=lookup)
+  thread.daemon = True
+  thread.start()
+  thread.join(timeout)
+  if 'addrinfo' in result:
+    addresses = []
+    for family, socktype, proto, canonname, sockaddr in result['addrinfo']:
+      if family in families and (family, sockaddr[0]) not in addresses:
+        addresses.append((family, sockaddr[0]))
+    return addresses, DNS_DEFAULT_TTL
+  elif 'error' in result and result['error'].errno in NEGATIVE_GAI_ERRORS:
+    return [], DNS_NEGATIVE_TTL
+  else:
     return None
-  return ip
 
 
 def get_rand_string(length):
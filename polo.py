@@ -1,20 +1,55 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import binascii
+import collections
 import hashlib
+import json
 import logging
+import multiprocessing
+import queue
+import re
+import selectors
+import signal
 import socket
+import struct
 import sys
+import time
 import urllib.parse
 try:
   import fauxdns
+  import polostats
 except ImportError:
   from . import fauxdns
+  from . import polostats
 assert sys.version_info.major >= 3, 'Python 3 required'
 
 TCP_PORT = 18088
 UDP_PORT = 35353
 BUFFER_SIZE = 1024
+MAX_CONNECTIONS = 1024
+READ_TIMEOUT = 10
+WORKER_REPORT_TIMEOUT = 5
+REPORT_INTERVAL = 1
+BATCH_SIZE = 64
+HTTP_PATH = '/uptest/polo'
+HTTP_REQUEST_LINE = re.compile(rb'^[A-Z]+ \S+ HTTP/\d\.\d\r?\n$')
+MAX_HEADER_LINES = 100
+# Longest DNS over TCP query we'll accept. Keeping it under 2048 means the first byte of the length
+# prefix is always under 8, a control character no HTTP request or raw challenge starts with.
+MAX_DNS_TCP_LENGTH = 2047
+# Largest HTTP request body we'll accept. A POSTed challenge only takes a few dozen bytes.
+MAX_HTTP_BODY = 4096
+HTTP_REASONS = {200:'OK', 400:'Bad Request', 404:'Not Found', 405:'Method Not Allowed',
+                413:'Payload Too Large', 501:'Not Implemented'}
+PROTOCOLS = {('udp', 'raw'):'udp', ('udp', 'dns'):'dns', ('tcp', 'raw'):'tcp', ('tcp', 'http'):'http',
+             ('tcp', 'dns'):'dns-tcp', ('tcp', 'session'):'tcp-session'}
+# A raw TCP client sends this instead of a challenge to start a session: it can then send any number
+# of newline-terminated challenges on the connection, and each digest comes back with a 2-byte
+# length prefix.
+SESSION_GREETING = b'polo-session/1\n'
+SESSION_ACK = b'polo-session/1 ok\n'
+SESSION_LENGTH = struct.Struct('!H')
 HASH_CONST = b'Bust those caches!'
 DESCRIPTION = """Reply to pings from upmonitor clients with expected responses.
 This server listens to UDP packets on the given port, and replies with a response derived from the
@@ -36,20 +71,58 @@ use: $ sudo iptables -t nat -I PREROUTING --src 0/0 -p udp --dport 53 -j REDIREC
 def make_argparser():
   parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG, add_help=False)
   parser.add_argument('ip', nargs='?', default='127.0.0.1',
-    help='Listen IP address. Default: %(default)s')
+    help='Listen IP address, IPv4 or IPv6. Default: %(default)s')
   parser.add_argument('-u', '--udp', dest='protocol', action='store_const', const='udp', default='udp',
     help='Use raw UDP as the protocol (the default).')
   parser.add_argument('-t', '--tcp', dest='protocol', action='store_const', const='tcp',
-    help='Use raw TCP as the protocol.')
+    help='Use raw TCP as the protocol. With --async, clients can also open a session to send '
+         'many challenges over one connection.')
   parser.add_argument('-d', '--dns', dest='protocol', action='store_const', const='dns',
     help='Use DNS as the protocol. The challenge will be in the place where the domain name is '
          'given in a DNS query. This script will then respond with a DNS response, encoding the '
          'hash where the IP address is normally given.')
+  parser.add_argument('-T', '--dns-tcp', dest='protocol', action='store_const', const='dns-tcp',
+    help='Use DNS over TCP as the protocol, with each query and response prefixed by its 2-byte '
+         'length, as in standard DNS. Clients can pipeline many queries on one connection. '
+         'Always uses the --async event loop. The default port is the same as for UDP DNS.')
   parser.add_argument('-w', '--http', dest='protocol', action='store_const', const='http',
-    help='Use HTTP as the protocol.')
+    help='Use HTTP as the protocol. This answers GET or POST requests to {}?challenge=[challenge] '
+         'with the same JSON as the Django view in views.py. Connections are kept alive and '
+         'pipelined requests are supported. Always uses the --async event loop.'.format(HTTP_PATH))
+  parser.add_argument('-a', '--all', dest='protocol', action='store_const', const='all',
+    help='Serve all the protocols at once from one event loop. Raw UDP and DNS share the UDP '
+         'port, and raw TCP, HTTP and DNS over TCP share the TCP port. Each packet or connection '
+         'is answered according to the protocol it looks like.')
   parser.add_argument('-p', '--port', type=int,
-    help='Port to listen on. Default for UDP/DNS: {}. Default for TCP/HTTP: {}'
+    help='Port to listen on. Default for UDP/DNS/DNS over TCP: {}. Default for TCP/HTTP: {}'
          .format(UDP_PORT, TCP_PORT))
+  parser.add_argument('--udp-port', type=int, default=UDP_PORT,
+    help='With --all, the port for UDP and DNS. Default: %(default)s')
+  parser.add_argument('--tcp-port', type=int, default=TCP_PORT,
+    help='With --all, the port for TCP, HTTP and DNS over TCP. Default: %(default)s')
+  parser.add_argument('--async', dest='asynchronous', action='store_true',
+    help='Serve TCP clients concurrently from an asyncio event loop, instead of handling one '
+         'connection at a time. Only applies to TCP.')
+  parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+    help='In --async mode, the maximum number of simultaneous TCP connections. Further connections '
+         'are closed immediately. Default: %(default)s')
+  parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+    help='In --async mode, close connections which don\'t send a full message within this many '
+         'seconds. Default: %(default)s')
+  parser.add_argument('--workers', type=int, default=1,
+    help='Serve UDP or DNS from this many processes, each with its own socket bound to the same '
+         'port with SO_REUSEPORT. The kernel will spread incoming packets across them. '
+         'Default: %(default)s')
+  parser.add_argument('--batch', type=int, metavar='SIZE',
+    help='For UDP and DNS, drain up to SIZE waiting datagrams on each wakeup and reply to them in '
+         'one burst, instead of handling one datagram at a time. Good for bursty traffic. '
+         'Suggested: {}'.format(BATCH_SIZE))
+  parser.add_argument('--stats-port', type=int,
+    help='Serve metrics (request rates, errors, service time histograms and kernel receive queue '
+         'drops) in Prometheus text format over HTTP on this port on 127.0.0.1.')
+  parser.add_argument('--stats-socket', metavar='PATH',
+    help='Serve the same metrics as --stats-port on a Unix socket at this path. Each connection '
+         'gets the text, then is closed.')
   parser.add_argument('-l', '--log', type=argparse.FileType('w'), default=sys.stderr,
     help='Print log messages to this file instead of to stderr. Warning: Will overwrite the file.')
   volume = parser.add_mutually_exclusive_group()
@@ -69,6 +142,14 @@ def main(argv):
 
   logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
 
+  counters = collections.Counter()
+
+  if args.protocol == 'all':
+    start_stats(args, counters, udp_ports=(args.udp_port,))
+    serve_all(args.ip, args.udp_port, args.tcp_port, counters=counters,
+              max_connections=args.max_connections, read_timeout=args.read_timeout)
+    return
+
   if args.port:
     port = args.port
   if args.protocol in ('udp', 'dns'):
@@ -79,63 +160,382 @@ def main(argv):
     transport = 'tcp'
     if not args.port:
       port = TCP_PORT
+  elif args.protocol == 'dns-tcp':
+    transport = 'tcp'
+    if not args.port:
+      port = UDP_PORT
 
   if args.protocol in ('udp', 'tcp'):
     application = 'raw'
+  elif args.protocol == 'dns-tcp':
+    application = 'dns'
   else:
     application = args.protocol
 
   if transport == 'udp':
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-  elif transport == 'tcp':
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Set these options to free up the port immediately exit:
-    # https://stackoverflow.com/questions/4465959/python-errno-98-address-already-in-use/4466035#4466035
-    # This is probably safe, since it's unlikely the client will re-use the same sending port.
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    start_stats(args, counters, udp_ports=(port,))
+  else:
+    start_stats(args, counters)
+
+  if args.workers > 1:
+    if transport != 'udp':
+      fail('Error: --workers is only supported for UDP and DNS.')
+    if logging.getLogger().getEffectiveLevel() < logging.CRITICAL:
+      print('Listening on {} port {} with {} workers..'.format(args.ip, port, args.workers),
+            file=sys.stderr)
+    serve_udp_workers(args.ip, port, application, args.workers, batch_size=args.batch,
+                      counters=counters)
+    log_counters(counters)
+    return
 
-  sock.bind((args.ip, port))
+  sock = make_socket(transport, args.ip, port)
 
   if logging.getLogger().getEffectiveLevel() < logging.CRITICAL:
     print('Listening on {} port {}..'.format(args.ip, port), file=sys.stderr)
 
   try:
+    # Keep-alive connections would starve everyone else in the one-at-a-time loop.
+    if transport == 'tcp' and (args.asynchronous or application in ('http', 'dns')):
+      asyncio.run(serve_tcp_async(sock, application, counters=counters,
+                                  max_connections=args.max_connections,
+                                  read_timeout=args.read_timeout))
     while True:
-      if transport == 'udp':
-        listen_udp(sock, application)
+      if transport == 'udp' and args.batch:
+        listen_udp_batch(sock, application, counters=counters, batch_size=args.batch)
+      elif transport == 'udp':
+        listen_udp(sock, application, counters=counters)
       elif transport == 'tcp':
         listen_tcp(sock, application)
   except KeyboardInterrupt:
     logging.info('Interrupted by user.')
   finally:
     sock.close()
+  log_counters(counters)
 
 
-def listen_udp(sock, application, hash_const=HASH_CONST):
-  while True:
-    contents, (ip, port) = sock.recvfrom(BUFFER_SIZE)
-    if application == 'raw':
-      message_bytes = contents
-    elif application == 'dns':
+def start_stats(args, counters, udp_ports=()):
+  if args.stats_port is None and args.stats_socket is None:
+    return None
+  try:
+    return polostats.start_stats_server(counters, port=args.stats_port, path=args.stats_socket,
+                                        udp_ports=udp_ports)
+  except OSError as error:
+    fail('Error: Could not open the stats socket: {}'.format(error))
+
+
+def serve_all(ip, udp_port, tcp_port, hash_const=HASH_CONST, counters=None,
+              max_connections=MAX_CONNECTIONS, read_timeout=READ_TIMEOUT):
+  """Serve raw UDP, DNS, raw TCP, HTTP and DNS over TCP from a single event loop, with shared
+  counters."""
+  if counters is None:
+    counters = collections.Counter()
+  udp_sock = make_socket('udp', ip, udp_port)
+  tcp_sock = make_socket('tcp', ip, tcp_port)
+  if logging.getLogger().getEffectiveLevel() < logging.CRITICAL:
+    print('Listening on {} UDP port {} and TCP port {}..'.format(ip, udp_port, tcp_port),
+          file=sys.stderr)
+  try:
+    asyncio.run(serve_all_async(udp_sock, tcp_sock, hash_const=hash_const, counters=counters,
+                                max_connections=max_connections, read_timeout=read_timeout))
+  except KeyboardInterrupt:
+    logging.info('Interrupted by user.')
+  finally:
+    udp_sock.close()
+    tcp_sock.close()
+  log_counters(counters)
+
+
+async def serve_all_async(udp_sock, tcp_sock, hash_const=HASH_CONST, counters=None,
+                          max_connections=MAX_CONNECTIONS, read_timeout=READ_TIMEOUT):
+  if counters is None:
+    counters = collections.Counter()
+  loop = asyncio.get_running_loop()
+  udp_transport, udp_protocol = await loop.create_datagram_endpoint(
+    lambda: UdpProtocol('any', counters, hash_const=hash_const), sock=udp_sock
+  )
+  try:
+    await serve_tcp_async(tcp_sock, 'any', hash_const=hash_const, counters=counters,
+                          max_connections=max_connections, read_timeout=read_timeout)
+  finally:
+    udp_transport.close()
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+  """Answer UDP datagrams from the event loop. If the application is "any", each datagram is
+  treated as DNS if it looks like a DNS query, and raw otherwise."""
+
+  def __init__(self, application, counters, hash_const=HASH_CONST):
+    self.application = application
+    self.counters = counters
+    self.hash_const = hash_const
+    self.transport = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, address):
+    if self.application == 'any':
+      application = 'dns' if fauxdns.is_dns_query(data) else 'raw'
+    else:
+      application = self.application
+    protocol = PROTOCOLS['udp', application]
+    self.counters[protocol, 'received'] += 1
+    start = time.perf_counter()
+    response = get_udp_reply(data, address, application, self.counters,
+                             hash_const=self.hash_const)
+    if response is not None:
+      self.transport.sendto(response, address)
+      polostats.observe_service_time(self.counters, protocol, time.perf_counter()-start)
+      self.counters[protocol, 'replied'] += 1
+
+
+def make_socket(transport, ip, port, reuse_port=False):
+  if ':' in ip:
+    family = socket.AF_INET6
+  else:
+    family = socket.AF_INET
+  if transport == 'udp':
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+  elif transport == 'tcp':
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    # Set these options to free up the port immediately exit:
+    # https://stackoverflow.com/questions/4465959/python-errno-98-address-already-in-use/4466035#4466035
+    # This is probably safe, since it's unlikely the client will re-use the same sending port.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuse_port:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  sock.bind((ip, port))
+  return sock
+
+
+def serve_udp_workers(ip, port, application, workers, batch_size=None, counters=None):
+  """Fork "workers" processes, each serving its own SO_REUSEPORT socket on the same port.
+  Runs until interrupted (SIGINT or SIGTERM), then stops the workers. The workers report their
+  counts every REPORT_INTERVAL seconds, and these are added to "counters", which is returned."""
+  if counters is None:
+    counters = collections.Counter()
+  # SO_REUSEPORT load balancing is a Linux feature anyway, so just use fork.
+  context = multiprocessing.get_context('fork')
+  results = context.Queue()
+  processes = []
+  finished = 0
+  signal.signal(signal.SIGTERM, raise_interrupt)
+  try:
+    for i in range(workers):
+      process = context.Process(target=udp_worker,
+                                args=(ip, port, application, results, batch_size))
+      process.start()
+      processes.append(process)
+    while finished < len(processes):
       try:
-        txn_id, message_encoded = fauxdns.split_dns_query(contents)
-        message = fauxdns.decode_dns_message(message_encoded)
-      except ValueError as error:
-        logging.error('Error: Problem parsing incoming query:\n'+str(error))
+        final, delta = results.get(timeout=REPORT_INTERVAL)
+      except queue.Empty:
         continue
-      message_bytes = bytes(message, 'utf8')
-    logging.info('Received from {} port {}: {!r}'.format(ip, port, message_bytes))
-    digest = get_hash(message_bytes, hash_const=hash_const)
-    if application == 'raw':
-      response = digest
-    elif application == 'dns':
+      counters.update(delta)
+      finished += final
+  except KeyboardInterrupt:
+    logging.info('Interrupted by user.')
+  finally:
+    # Ctrl-C reaches the whole process group, but a SIGTERM only reaches us.
+    for process in processes:
+      if process.is_alive():
+        process.terminate()
+  # Collect the final reports before joining, so no worker is left blocked on a full queue.
+  while finished < len(processes):
+    try:
+      final, delta = results.get(timeout=WORKER_REPORT_TIMEOUT)
+    except queue.Empty:
+      logging.warning('Warning: {} worker(s) failed to report their counters.'
+                      .format(len(processes)-finished))
+      break
+    counters.update(delta)
+    finished += final
+  for process in processes:
+    process.join()
+  return counters
+
+
+def udp_worker(ip, port, application, results, batch_size=None):
+  signal.signal(signal.SIGTERM, raise_interrupt)
+  counters = collections.Counter()
+  def report(counters):
+    # Send only what's new since the last report.
+    results.put((False, collections.Counter(counters)))
+    counters.clear()
+  sock = None
+  try:
+    sock = make_socket('udp', ip, port, reuse_port=True)
+    if batch_size:
+      listen_udp_batch(sock, application, counters=counters, batch_size=batch_size, report=report)
+    else:
+      listen_udp(sock, application, counters=counters, report=report)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    # We may be signalled twice (by the parent and by a Ctrl-C to the process group). Don't let the
+    # second signal interrupt the report.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if sock is not None:
+      sock.close()
+    results.put((True, counters))
+
+
+def raise_interrupt(signum, frame):
+  raise KeyboardInterrupt
+
+
+def log_counters(counters):
+  if logging.getLogger().getEffectiveLevel() < logging.CRITICAL:
+    for key, count in sorted(counters.items()):
+      print('{}: {}'.format(' '.join(map(str, key)), count), file=sys.stderr)
+
+
+def listen_udp(sock, application, hash_const=HASH_CONST, counters=None, report=None):
+  """Answer datagrams one at a time, forever. If "report" is given, it's called with "counters"
+  about every REPORT_INTERVAL seconds."""
+  if counters is None:
+    counters = collections.Counter()
+  protocol = PROTOCOLS['udp', application]
+  if report is not None:
+    sock.settimeout(REPORT_INTERVAL)
+    next_report = time.monotonic() + REPORT_INTERVAL
+  while True:
+    if report is not None and time.monotonic() >= next_report:
+      report(counters)
+      next_report = time.monotonic() + REPORT_INTERVAL
+    try:
+      contents, address = sock.recvfrom(BUFFER_SIZE)
+    except socket.timeout:
+      continue
+    counters[protocol, 'received'] += 1
+    start = time.perf_counter()
+    response = get_udp_reply(contents, address, application, counters, hash_const=hash_const)
+    if response is not None:
+      sock.sendto(response, address)
+      polostats.observe_service_time(counters, protocol, time.perf_counter()-start)
+      counters[protocol, 'replied'] += 1
+
+
+def listen_udp_batch(sock, application, hash_const=HASH_CONST, counters=None,
+                     batch_size=BATCH_SIZE, report=None):
+  """Like listen_udp(), but after each wakeup, drain every datagram that's already waiting (up to
+  "batch_size") before replying to them all in one burst. This amortizes the per-packet overhead
+  when packets arrive in bursts."""
+  if counters is None:
+    counters = collections.Counter()
+  protocol = PROTOCOLS['udp', application]
+  # Preallocate the receive buffers once and reuse them for every batch.
+  buffers = [memoryview(bytearray(BUFFER_SIZE)) for i in range(batch_size)]
+  lengths = [0] * batch_size
+  addresses = [None] * batch_size
+  sock.setblocking(False)
+  selector = selectors.DefaultSelector()
+  selector.register(sock, selectors.EVENT_READ)
+  timeout = None
+  if report is not None:
+    next_report = time.monotonic() + REPORT_INTERVAL
+  while True:
+    if report is not None:
+      now = time.monotonic()
+      if now >= next_report:
+        report(counters)
+        next_report = now + REPORT_INTERVAL
+      timeout = next_report - now
+    # Wait for the socket to become readable, then take whatever is queued without blocking.
+    if not selector.select(timeout):
+      continue
+    count = 0
+    while count < batch_size:
       try:
-        response = fauxdns.encode_dns_response(txn_id, message_encoded, digest)
-      except ValueError as error:
-        logging.error('Error: Problem encoding response:\n'+str(error))
-        continue
-    sock.sendto(response, (ip, port))
-    logging.info('Replied with hash {}'.format(bytes_to_hex(digest)))
+        lengths[count], addresses[count] = sock.recvfrom_into(buffers[count])
+      except BlockingIOError:
+        break
+      count += 1
+    if count == 0:
+      continue
+    counters[protocol, 'received'] += count
+    counters[protocol, 'wakeups'] += 1
+    counters[protocol, 'batch size', count] += 1
+    start = time.perf_counter()
+    replies = []
+    for i in range(count):
+      contents = buffers[i][:lengths[i]]
+      response = get_udp_reply(contents, addresses[i], application, counters,
+                               hash_const=hash_const)
+      if response is not None:
+        replies.append((response, addresses[i]))
+    for response, address in replies:
+      sock.sendto(response, address)
+    # We only know how long the whole batch took, so record each reply as taking the average.
+    if replies:
+      polostats.observe_service_time(counters, protocol, (time.perf_counter()-start)/len(replies),
+                                     count=len(replies))
+    counters[protocol, 'replied'] += len(replies)
+
+
+def get_udp_reply(contents, address, application, counters, hash_const=HASH_CONST, transport='udp'):
+  """Compute the reply to one incoming datagram. "contents" can be bytes or a memoryview.
+  Returns None if the datagram can't be answered. Also answers DNS queries read from a TCP
+  connection (without their length prefix), when "transport" is 'tcp'."""
+  protocol = PROTOCOLS[transport, application]
+  # Don't pay for formatting log messages nobody will see.
+  verbose = logging.getLogger().isEnabledFor(logging.INFO)
+  if application == 'raw':
+    message_bytes = contents
+  elif application == 'dns':
+    if contents[fauxdns.TXN_ID_LEN:fauxdns.QUERY_HEADER_END] != fauxdns.DNS_QUERY_HEADER:
+      # Not the usual single question. It may be a batch of several.
+      return get_dns_multi_reply(contents, address, counters, hash_const=hash_const,
+                                 protocol=protocol)
+    try:
+      txn_id, message_encoded = fauxdns.split_dns_query(contents)
+      message = fauxdns.decode_dns_message(message_encoded)
+    except ValueError as error:
+      counters[protocol, 'malformed'] += 1
+      logging.error('Error: Problem parsing incoming query:\n'+str(error))
+      return None
+    message_bytes = bytes(message, 'utf8')
+  if verbose:
+    logging.info('Received from {} port {}: {!r}'.format(address[0], address[1],
+                                                         bytes(message_bytes)))
+  digest = get_hash(message_bytes, hash_const=hash_const)
+  if application == 'raw':
+    response = digest
+  elif application == 'dns':
+    try:
+      response = fauxdns.encode_dns_response(txn_id, message_encoded, digest)
+    except ValueError as error:
+      counters[protocol, 'failed'] += 1
+      logging.error('Error: Problem encoding response:\n'+str(error))
+      return None
+  if verbose:
+    logging.info('Replying with hash {}'.format(bytes_to_hex(digest)))
+  return response
+
+
+def get_dns_multi_reply(contents, address, counters, hash_const=HASH_CONST, protocol='dns'):
+  """Answer a DNS query carrying several challenges, one per question, with one answer record per
+  challenge. Returns None if it can't be answered."""
+  verbose = logging.getLogger().isEnabledFor(logging.INFO)
+  try:
+    txn_id, messages_encoded = fauxdns.split_dns_multi_query(contents)
+    messages = [fauxdns.decode_dns_message(message_encoded) for message_encoded in messages_encoded]
+  except ValueError as error:
+    counters[protocol, 'malformed'] += 1
+    logging.error('Error: Problem parsing incoming query:\n'+str(error))
+    return None
+  if verbose:
+    logging.info('Received {} challenges from {} port {}: {!r}'
+                 .format(len(messages), address[0], address[1], messages))
+  digests = [get_hash(bytes(message, 'utf8'), hash_const=hash_const) for message in messages]
+  counters[protocol, 'challenges'] += len(digests)
+  try:
+    return fauxdns.encode_dns_multi_response(txn_id, messages_encoded, digests)
+  except ValueError as error:
+    counters[protocol, 'failed'] += 1
+    logging.error('Error: Problem encoding response:\n'+str(error))
+    return None
 
 
 def listen_tcp(sock, application, hash_const=HASH_CONST):
@@ -163,9 +563,330 @@ def listen_tcp(sock, application, hash_const=HASH_CONST):
     connection.sendall(digest)
 
 
+async def serve_tcp_async(sock, application, hash_const=HASH_CONST, counters=None,
+                          max_connections=MAX_CONNECTIONS, read_timeout=READ_TIMEOUT):
+  """Serve TCP clients from an event loop, so a slow client doesn't hold up any others.
+  Connections beyond "max_connections" are closed immediately, and clients which don't send a full
+  message within "read_timeout" seconds are dropped."""
+  if counters is None:
+    counters = collections.Counter()
+  connections = 0
+  async def handler(reader, writer):
+    nonlocal connections
+    if connections >= max_connections:
+      logging.warning('Warning: At the limit of {} connections. Refusing a new one.'
+                      .format(max_connections))
+      counters[PROTOCOLS.get(('tcp', application), 'tcp'), 'refused'] += 1
+      writer.close()
+      return
+    connections += 1
+    try:
+      await handle_tcp_async(reader, writer, application, counters, hash_const=hash_const,
+                             read_timeout=read_timeout)
+    finally:
+      connections -= 1
+  server = await asyncio.start_server(handler, sock=sock, backlog=max_connections)
+  async with server:
+    await server.serve_forever()
+
+
+async def handle_tcp_async(reader, writer, application, counters, hash_const=HASH_CONST,
+                           read_timeout=READ_TIMEOUT):
+  ip, port = writer.get_extra_info('peername')[:2]
+  try:
+    if application == 'any':
+      # Tell DNS over TCP by its length prefix, then HTTP from raw TCP by the first line.
+      first_byte = await asyncio.wait_for(reader.read(1), read_timeout)
+      if not first_byte:
+        return
+      if first_byte[0] <= MAX_DNS_TCP_LENGTH >> 8:
+        await handle_dns_tcp_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                                   read_timeout=read_timeout, first_byte=first_byte)
+        return
+      first_line = first_byte
+      if first_byte != b'\n':
+        first_line += await read_line(reader, read_timeout)
+      if HTTP_REQUEST_LINE.match(first_line):
+        await handle_http_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                                read_timeout=read_timeout, first_line=first_line)
+      else:
+        await handle_raw_tcp_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                                   read_timeout=read_timeout, contents=first_line)
+    elif application == 'raw':
+      await handle_raw_tcp_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                                 read_timeout=read_timeout)
+    elif application == 'http':
+      await handle_http_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                              read_timeout=read_timeout)
+    elif application == 'dns':
+      await handle_dns_tcp_async(reader, writer, (ip, port), counters, hash_const=hash_const,
+                                 read_timeout=read_timeout)
+  except asyncio.TimeoutError:
+    logging.warning('Warning: Timed out waiting for a message from {} port {}.'.format(ip, port))
+  except asyncio.LimitOverrunError:
+    logging.warning('Warning: Message from {} port {} is too long.'.format(ip, port))
+  except (ConnectionError, asyncio.IncompleteReadError) as error:
+    logging.warning('Warning: Lost connection to {} port {}: {}'.format(ip, port, error))
+  finally:
+    writer.close()
+
+
+async def handle_raw_tcp_async(reader, writer, address, counters, hash_const=HASH_CONST,
+                               read_timeout=READ_TIMEOUT, contents=None):
+  """Answer a single newline-terminated message. If the message was already read, give it as
+  "contents". If the message is the session greeting, start a session instead."""
+  if contents is None:
+    contents = await read_line(reader, read_timeout)
+  if contents == SESSION_GREETING:
+    await handle_session_async(reader, writer, address, counters, hash_const=hash_const,
+                               read_timeout=read_timeout)
+    return
+  if contents.endswith(b'\n'):
+    message_bytes = contents[:-1]
+  else:
+    # The client closed its side without sending a newline. Like listen_tcp(), answer what we got.
+    message_bytes = contents
+  counters['tcp', 'received'] += 1
+  logging.info('Received from {} port {}: {!r}'.format(address[0], address[1], message_bytes))
+  start = time.perf_counter()
+  digest = get_hash(message_bytes, hash_const=hash_const)
+  writer.write(digest)
+  polostats.observe_service_time(counters, 'tcp', time.perf_counter()-start)
+  await writer.drain()
+  counters['tcp', 'replied'] += 1
+
+
+async def handle_session_async(reader, writer, address, counters, hash_const=HASH_CONST,
+                               read_timeout=READ_TIMEOUT):
+  """Answer newline-terminated challenges with length-prefixed digests until the client closes the
+  connection or goes quiet for "read_timeout" seconds."""
+  writer.write(SESSION_ACK)
+  await writer.drain()
+  while True:
+    try:
+      line = await asyncio.wait_for(reader.readuntil(b'\n'), read_timeout)
+    except asyncio.IncompleteReadError as error:
+      if error.partial:
+        counters['tcp-session', 'malformed'] += 1
+        logging.warning('Warning: Session closed in the middle of a challenge.')
+      return
+    except asyncio.TimeoutError:
+      return
+    counters['tcp-session', 'received'] += 1
+    message_bytes = line[:-1]
+    logging.info('Received from {} port {}: {!r}'.format(address[0], address[1], message_bytes))
+    start = time.perf_counter()
+    digest = get_hash(message_bytes, hash_const=hash_const)
+    writer.write(SESSION_LENGTH.pack(len(digest)) + digest)
+    polostats.observe_service_time(counters, 'tcp-session', time.perf_counter()-start)
+    await writer.drain()
+    counters['tcp-session', 'replied'] += 1
+
+
+async def handle_http_async(reader, writer, address, counters, hash_const=HASH_CONST,
+                            read_timeout=READ_TIMEOUT, first_line=None):
+  """Answer HTTP requests on one connection until the client closes it, asks us to close it, or
+  goes quiet for "read_timeout" seconds. Requests are read and answered strictly in order, so
+  pipelined requests work too. If the request line of the first request was already read, give it
+  as "first_line"."""
+  while True:
+    try:
+      head = await asyncio.wait_for(read_http_head(reader, first_line), read_timeout)
+    except asyncio.IncompleteReadError as error:
+      if error.partial.strip() or first_line:
+        counters['http', 'malformed'] += 1
+        logging.warning('Warning: Connection closed in the middle of a request.')
+      return
+    except asyncio.TimeoutError:
+      # An idle keep-alive connection. Just let it go.
+      return
+    except ValueError as error:
+      counters['http', 'malformed'] += 1
+      logging.error('Error: Problem reading incoming request:\n'+str(error))
+      return
+    first_line = None
+    counters['http', 'received'] += 1
+    try:
+      method, target, version, headers = parse_http_head(head)
+      # We can't tell where the body of these ends, so the connection can't be used any further.
+      if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+        await refuse_http_request(writer, counters, 501, 'Transfer-Encoding is not supported.')
+        return
+      if int(headers.get('content-length', 0)) > MAX_HTTP_BODY:
+        await refuse_http_request(writer, counters, 413, 'Request body is over the limit of {} '
+                                  'bytes.'.format(MAX_HTTP_BODY))
+        return
+      body = b''
+      if 'content-length' in headers:
+        body = await asyncio.wait_for(reader.readexactly(int(headers['content-length'])),
+                                      read_timeout)
+    except ValueError as error:
+      counters['http', 'malformed'] += 1
+      logging.error('Error: Problem parsing incoming request:\n'+str(error))
+      writer.write(format_http_response(400, b'Malformed request.', keep_alive=False))
+      await writer.drain()
+      return
+    keep_alive = is_keep_alive(version, headers)
+    ip = headers.get('x-real-ip', address[0])
+    start = time.perf_counter()
+    status, response_headers, response_body = get_http_reply(method, target, headers, body, ip,
+                                                             hash_const=hash_const)
+    writer.write(format_http_response(status, response_body, headers=response_headers,
+                                      keep_alive=keep_alive, version=version))
+    polostats.observe_service_time(counters, 'http', time.perf_counter()-start)
+    await writer.drain()
+    counters['http', 'replied'] += 1
+    if not keep_alive:
+      return
+
+
+async def refuse_http_request(writer, counters, status, message):
+  """Reply with an error "status" and "message", and ask the client to close the connection."""
+  counters['http', 'malformed'] += 1
+  logging.error('Error: Refusing request: '+message)
+  writer.write(format_http_response(status, bytes(message, 'utf8'), keep_alive=False))
+  await writer.drain()
+
+
+async def handle_dns_tcp_async(reader, writer, address, counters, hash_const=HASH_CONST,
+                               read_timeout=READ_TIMEOUT, first_byte=None):
+  """Answer length-prefixed DNS queries on one connection until the client closes it or goes quiet
+  for "read_timeout" seconds. Each query is answered as soon as it's read, so clients can pipeline
+  them and match up the responses by transaction ID. If the first byte of the first length prefix
+  was already read, give it as "first_byte"."""
+  while True:
+    try:
+      if first_byte is None:
+        prefix = await asyncio.wait_for(reader.readexactly(fauxdns.TCP_LENGTH.size), read_timeout)
+      else:
+        prefix = first_byte + await asyncio.wait_for(reader.readexactly(1), read_timeout)
+    except asyncio.IncompleteReadError as error:
+      if error.partial or first_byte:
+        counters['dns-tcp', 'malformed'] += 1
+        logging.warning('Warning: Connection closed in the middle of a query.')
+      return
+    except asyncio.TimeoutError:
+      # An idle connection. Just let it go.
+      return
+    first_byte = None
+    length, = fauxdns.TCP_LENGTH.unpack(prefix)
+    if length > MAX_DNS_TCP_LENGTH:
+      counters['dns-tcp', 'malformed'] += 1
+      logging.error('Error: Query length ({}) is over the limit of {}.'
+                    .format(length, MAX_DNS_TCP_LENGTH))
+      return
+    query = await asyncio.wait_for(reader.readexactly(length), read_timeout)
+    counters['dns-tcp', 'received'] += 1
+    start = time.perf_counter()
+    response = get_udp_reply(query, address, 'dns', counters, hash_const=hash_const,
+                             transport='tcp')
+    if response is None:
+      # Skipping a response would leave the client waiting on it, so hang up instead.
+      return
+    writer.write(fauxdns.frame_tcp(response))
+    polostats.observe_service_time(counters, 'dns-tcp', time.perf_counter()-start)
+    await writer.drain()
+    counters['dns-tcp', 'replied'] += 1
+
+
+async def read_line(reader, read_timeout=READ_TIMEOUT):
+  """Read one line, including the newline. If the client closes its side first, return the partial
+  line instead."""
+  try:
+    return await asyncio.wait_for(reader.readuntil(b'\n'), read_timeout)
+  except asyncio.IncompleteReadError as error:
+    return error.partial
+
+
+async def read_http_head(reader, first_line=None):
+  """Read the request line and headers of an HTTP request, up to and including the blank line."""
+  lines = []
+  line = first_line
+  while True:
+    if line is None:
+      line = await reader.readuntil(b'\n')
+    lines.append(line)
+    if not line.strip():
+      break
+    if len(lines) > MAX_HEADER_LINES:
+      raise ValueError('More than {} header lines.'.format(MAX_HEADER_LINES))
+    line = None
+  return b''.join(lines)
+
+
+def parse_http_head(head):
+  """Parse the request line and headers of an HTTP request.
+  Returns the method, request target, HTTP version, and a dict of headers with lowercased names.
+  Raises ValueError if it's malformed."""
+  lines = [line.rstrip('\r') for line in str(head, 'iso-8859-1').split('\n')]
+  fields = lines[0].split()
+  if len(fields) != 3 or not fields[2].startswith('HTTP/'):
+    raise ValueError('Malformed request line: {!r}'.format(lines[0]))
+  method, target, version = fields
+  headers = {}
+  for line in lines[1:]:
+    if not line:
+      continue
+    name, colon, value = line.partition(':')
+    if not colon:
+      raise ValueError('Malformed header line: {!r}'.format(line))
+    headers[name.strip().lower()] = value.strip()
+  if 'content-length' in headers and not headers['content-length'].isdigit():
+    raise ValueError('Invalid Content-Length: {!r}'.format(headers['content-length']))
+  return method, target, version, headers
+
+
+def is_keep_alive(version, headers):
+  connection = headers.get('connection', '').lower()
+  if version == 'HTTP/1.0':
+    return connection == 'keep-alive'
+  else:
+    return connection != 'close'
+
+
+def get_http_reply(method, target, headers, body, ip, hash_const=HASH_CONST):
+  """Compute the response to a polo HTTP request, matching the Django views.reply() view.
+  Returns the status code, a dict of extra headers, and the response body."""
+  url = urllib.parse.urlsplit(target)
+  if url.path != HTTP_PATH:
+    return 404, {}, b'Not found.'
+  if method == 'POST':
+    params = urllib.parse.parse_qs(str(body, 'utf8', 'replace'))
+  elif method == 'GET':
+    params = urllib.parse.parse_qs(url.query)
+  else:
+    return 405, {'Allow':'POST, GET'}, b''
+  # Like Django's QueryDict.get(), use the last value given for a parameter.
+  txn_id = params.get('txn', [None])[-1]
+  challenge = params.get('challenge', [None])[-1]
+  if not challenge:
+    return 400, {}, b'Missing parameters.'
+  challenge_bytes = bytes(challenge, 'utf8')
+  logging.info('Received from {}: {!r}'.format(ip, challenge_bytes))
+  digest = get_hash(challenge_bytes, hash_const=hash_const)
+  response_data = {'txn':txn_id, 'digest':bytes_to_hex(digest)}
+  return 200, {'Content-Type':'application/json'}, bytes(json.dumps(response_data), 'utf8')
+
+
+def format_http_response(status, body, headers=None, keep_alive=True, version='HTTP/1.1'):
+  lines = ['{} {} {}'.format(version, status, HTTP_REASONS.get(status, ''))]
+  if headers:
+    for name, value in headers.items():
+      lines.append('{}: {}'.format(name, value))
+  lines.append('Content-Length: {}'.format(len(body)))
+  if not keep_alive:
+    lines.append('Connection: close')
+  elif version == 'HTTP/1.0':
+    lines.append('Connection: keep-alive')
+  head = '\r\n'.join(lines)+'\r\n\r\n'
+  return bytes(head, 'iso-8859-1') + body
+
+
 def get_hash(data, hash_const=HASH_CONST, algorithm='sha256'):
   hasher = hashlib.new(algorithm)
-  hasher.update(hash_const+data)
+  # Update in two steps instead of concatenating, so "data" can be any bytes-like object.
+  hasher.update(hash_const)
+  hasher.update(data)
   return hasher.digest()
 
 
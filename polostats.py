@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Expose polo.py's counters in the Prometheus text format, on a local TCP port or Unix socket.
+The counters are a collections.Counter keyed by tuples, starting with the protocol and the event,
+like ('udp', 'received'). This module also defines the service time histogram stored in them."""
+import bisect
+import logging
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+assert sys.version_info.major >= 3, 'Python 3 required'
+
+# Upper bounds (in seconds) of the service time histogram buckets.
+SERVICE_TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1,
+                        float('inf'))
+EVENT_METRICS = {
+  'received': ('polo_requests_total', 'Requests received.'),
+  'replied': ('polo_replies_total', 'Replies sent.'),
+  'malformed': ('polo_malformed_total', 'Requests which could not be parsed.'),
+  'failed': ('polo_failed_total', 'Requests which could not be answered.'),
+  'refused': ('polo_refused_total', 'Connections refused because of the connection limit.'),
+  'wakeups': ('polo_wakeups_total', 'Times the batched UDP loop woke up to drain the socket.'),
+  'challenges': ('polo_batched_challenges_total', 'Challenges in multi-question DNS queries.'),
+}
+PROC_UDP_FILES = ('/proc/net/udp', '/proc/net/udp6')
+REQUEST_TIMEOUT = 2
+
+
+def observe_service_time(counters, protocol, seconds, count=1):
+  """Record "count" requests which each took "seconds" to hash and reply to."""
+  le = SERVICE_TIME_BUCKETS[bisect.bisect_left(SERVICE_TIME_BUCKETS, seconds)]
+  counters[protocol, 'service time', le] += count
+  counters[protocol, 'service time sum'] += seconds * count
+
+
+def start_stats_server(counters, port=None, path=None, udp_ports=()):
+  """Serve the metrics from a background thread, on 127.0.0.1 "port" or the Unix socket "path".
+  "udp_ports" are the ports to report kernel receive queue drops for."""
+  if path is not None:
+    # Clear out a socket left behind by an earlier run, but don't delete anything else.
+    try:
+      mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+      mode = None
+    if mode is not None:
+      if not stat.S_ISSOCK(mode):
+        raise FileExistsError('{} already exists and is not a socket'.format(path))
+      os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+  else:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+  sock.listen()
+  thread = threading.Thread(target=serve_stats, args=(sock, counters, udp_ports), daemon=True)
+  thread.start()
+  return sock
+
+
+def serve_stats(sock, counters, udp_ports=()):
+  """Answer each connection with the current metrics. Over TCP, this speaks just enough HTTP for a
+  Prometheus scraper. Over a Unix socket, it writes the bare text and closes the connection."""
+  http = sock.family != socket.AF_UNIX
+  last = {'time':time.monotonic(), 'received':{}}
+  while True:
+    connection, address = sock.accept()
+    with connection:
+      try:
+        if http:
+          read_http_request(connection)
+        body = bytes(format_metrics(counters, udp_ports=udp_ports, last=last), 'utf8')
+        if http:
+          head = ('HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                  'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(len(body)))
+          connection.sendall(bytes(head, 'ascii'))
+        connection.sendall(body)
+      except OSError as error:
+        logging.warning('Warning: Problem serving stats: {}'.format(error))
+
+
+def read_http_request(connection):
+  """Read and discard the request, up to the blank line that ends its headers."""
+  connection.settimeout(REQUEST_TIMEOUT)
+  data = b''
+  while b'\r\n\r\n' not in data and b'\n\n' not in data:
+    buf = connection.recv(1024)
+    if not buf:
+      break
+    data += buf
+
+
+def format_metrics(counters, udp_ports=(), last=None):
+  """Format the counters as Prometheus text. If "last" is a dict, it's used to remember the previous
+  call, so the requests per second since then can be reported."""
+  # Copy first, since the serving threads or processes keep updating the original. Copying a dict
+  # happens atomically under the GIL, unlike iterating over it.
+  snapshot = dict(counters)
+  protocols = sorted({key[0] for key in snapshot})
+  lines = []
+  for event, (name, description) in EVENT_METRICS.items():
+    values = [(protocol, snapshot[protocol, event]) for protocol in protocols
+              if (protocol, event) in snapshot]
+    if event == 'received' or values:
+      lines.extend(format_header(name, 'counter', description))
+      for protocol, value in values:
+        lines.append('{}{{protocol="{}"}} {}'.format(name, protocol, value))
+  if last is not None:
+    now = time.monotonic()
+    elapsed = now - last['time']
+    lines.extend(format_header('polo_requests_per_second', 'gauge',
+                               'Requests per second since the previous scrape.'))
+    for protocol in protocols:
+      received = snapshot.get((protocol, 'received'), 0)
+      if elapsed > 0:
+        rate = (received - last['received'].get(protocol, 0)) / elapsed
+        lines.append('polo_requests_per_second{{protocol="{}"}} {:0.2f}'.format(protocol, rate))
+      last['received'][protocol] = received
+    last['time'] = now
+  lines.extend(format_header('polo_service_seconds', 'histogram',
+                             'Time taken to hash a challenge and send the reply.'))
+  for protocol in protocols:
+    cumulative = 0
+    for le in SERVICE_TIME_BUCKETS:
+      cumulative += snapshot.get((protocol, 'service time', le), 0)
+      le_str = '+Inf' if le == float('inf') else repr(le)
+      lines.append('polo_service_seconds_bucket{{protocol="{}",le="{}"}} {}'
+                   .format(protocol, le_str, cumulative))
+    lines.append('polo_service_seconds_sum{{protocol="{}"}} {:0.6f}'
+                 .format(protocol, snapshot.get((protocol, 'service time sum'), 0)))
+    lines.append('polo_service_seconds_count{{protocol="{}"}} {}'.format(protocol, cumulative))
+  if udp_ports:
+    lines.extend(format_header('polo_udp_drops_total', 'counter',
+                               'Datagrams dropped by the kernel because the receive queue was full.'))
+    lines.extend(format_header('polo_udp_receive_queue_bytes', 'gauge',
+                               'Bytes waiting in the kernel receive queue.'))
+    for port in udp_ports:
+      queue_stats = get_udp_queue_stats(port)
+      if queue_stats is not None:
+        drops, queued = queue_stats
+        lines.append('polo_udp_drops_total{{port="{}"}} {}'.format(port, drops))
+        lines.append('polo_udp_receive_queue_bytes{{port="{}"}} {}'.format(port, queued))
+  return '\n'.join(lines)+'\n'
+
+
+def format_header(name, metric_type, description):
+  return ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, metric_type)]
+
+
+def get_udp_queue_stats(port, proc_paths=PROC_UDP_FILES):
+  """Sum the kernel's drop counts and receive queue sizes for all UDP sockets bound to "port"
+  (there can be several, with SO_REUSEPORT). Reads /proc/net/udp, so this only works on Linux.
+  Returns (drops, queued_bytes), or None if the information isn't available."""
+  drops = 0
+  queued = 0
+  found = False
+  for proc_path in proc_paths:
+    try:
+      with open(proc_path) as proc_file:
+        next(proc_file)  # Skip the header.
+        for line in proc_file:
+          fields = line.split()
+          # The fields are: sl local_address rem_address st tx_queue:rx_queue tr tm->when retrnsmt
+          #                 uid timeout inode ref pointer drops
+          try:
+            local_port = int(fields[1].split(':')[1], 16)
+            rx_queue = int(fields[4].split(':')[1], 16)
+            sock_drops = int(fields[-1])
+          except (IndexError, ValueError):
+            continue
+          if local_port == port:
+            found = True
+            drops += sock_drops
+            queued += rx_queue
+    except (OSError, StopIteration):
+      continue
+  if found:
+    return drops, queued
+  else:
+    return None
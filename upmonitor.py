@@ -1,8 +1,4 @@
 #!/usr/bin/env python
-#TODO: Use asyncio?
-#      Will allow asynchronous pings separate from the main thread.
-#      A good example is under "A more realistic yet simple example" here:
-#      https://hackernoon.com/a-simple-introduction-to-pythons-asyncio-595d9c9ecf8c
 #TODO: Try requests library instead of httplib (can be packaged with the code)?
 #TODO: Maybe an algorithm to automatically switch to curl if there's a streak of failed pings (so no
 #      manual intervention is needed).
@@ -15,9 +11,16 @@ import sys
 import copy
 import time
 import errno
+import Queue
+import ctypes
 import signal
+import socket
+import struct
 import numbers
 import argparse
+import threading
+import traceback
+import collections
 import ConfigParser
 import ipwraplib
 import pings
@@ -29,20 +32,42 @@ HISTORY_FILENAME = 'uphistory.txt'
 STATUS_FILENAME = 'upstatus.txt'
 CONFIG_FILENAME = 'upmonitor.cfg'
 SHUTDOWN_STATUS = 'OFFLINE'
+# inotify event flags (from <sys/inotify.h>) which mean the config file may have changed:
+# IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE and IN_DELETE.
+INOTIFY_MASK = 0x2 | 0x8 | 0x80 | 0x100 | 0x200
+IN_Q_OVERFLOW = 0x4000
+# The header of struct inotify_event: wd, mask, cookie, and the length of the name which follows.
+INOTIFY_EVENT = struct.Struct(str('iIII'))
 DETECTORS = {
   'google': {'server':'www.gstatic.com', 'path':'/generate_204', 'status':204, 'body':''},
   'mozilla': {'server':'detectportal.firefox.com', 'path':'/success.txt', 'status':200,
               'body':'success\n'},
-  'nstoler': {'server':'polo.nstoler.com', 'path':'/uptest/polo', 'status':200, 'body':None}
+  'nstoler': {'server':'polo.nstoler.com', 'path':'/uptest/polo', 'status':200, 'body':None},
+  'msftncsi': {'server':'www.msftncsi.com', 'path':'/ncsi.txt', 'status':200,
+               'body':'Microsoft NCSI'},
+  'apple': {'server':'www.apple.com', 'path':'/library/test/success.html', 'status':200,
+            'body':'<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>\n'},
+  'google-com': {'server':'google.com', 'path':'/generate_204', 'status':204, 'body':''},
+  'clients3': {'server':'clients3.google.com', 'path':'/generate_204', 'status':204, 'body':''},
+  'android': {'server':'connectivitycheck.android.com', 'path':'/generate_204', 'status':204,
+              'body':''},
+  'connectivitycheck': {'server':'connectivitycheck.gstatic.com', 'path':'/generate_204',
+                        'status':204, 'body':''},
 }
 DETECTOR_ALIASES = {'google.com':'google', 'gstatic.com':'google', 'www.gstatic.com':'google',
                     'polo':'nstoler', 'nstoler.com':'nstoler', 'polo.nstoler.com':'nstoler',
-                    'firefox':'mozilla', 'firefox.com':'mozilla', 'detectportal.firefox.com':'mozilla'}
-METHODS = ('ping', 'curl', 'httplib', 'polo')
+                    'firefox':'mozilla', 'firefox.com':'mozilla', 'detectportal.firefox.com':'mozilla',
+                    'microsoft':'msftncsi', 'msftncsi.com':'msftncsi',
+                    'www.msftncsi.com':'msftncsi',
+                    'apple.com':'apple', 'www.apple.com':'apple',
+                    'clients3.google.com':'clients3',
+                    'connectivitycheck.android.com':'android',
+                    'connectivitycheck.gstatic.com':'connectivitycheck'}
+METHODS = ('ping', 'icmp', 'curl', 'connect', 'head', 'httplib', 'polo', 'race', 'persistent')
 POLO_SERVER = 'nstoler'
 
 OPT_DEFAULTS = {'server':'google.com', 'history_length':5, 'frequency':5, 'timeout':2,
-                'method':'ping'}
+                'method':'ping', 'dns_refresh':10, 'quorum':2}
 DESCRIPTION = """Track and summarize the recent history of connectivity by pinging an external
 server. Can print a textual summary figure to stdout or to a file, which can be read and displayed
 by utilities like indicator-sysmonitor. This allows visual monitoring of real, current connectivity.
@@ -65,9 +90,10 @@ def make_parser():
   parser.set_defaults(**OPT_DEFAULTS)
   opts = {}
   opts['server'] = parser.add_argument('-s', '--server',
-    help='The server to ping. If the --method is "ping" or "curl", then give any domain name. '
-         'For "httplib" and "polo" methods, choose from the following captive portal detectors: '
-         +describe_detectors(DETECTORS))
+    help='The server to ping. If the --method is "ping", "icmp", "curl", "connect" or "head", '
+         'then give any domain name. For "httplib", "polo" and "persistent" methods, choose from '
+         'the following captive portal detectors: '+describe_detectors(DETECTORS)+'. The "race" '
+         'method ignores this and uses all of them.')
   opts['stdout'] = parser.add_argument('-o', '--stdout', action='store_true',
     help='Print status summary to stdout instead of a file.')
   opts['frequency'] = parser.add_argument('-f', '--frequency', type=int,
@@ -77,16 +103,34 @@ def make_parser():
     help='The number of previous ping tests to keep track of and display. Default: %(default)s')
   opts['method'] = parser.add_argument('-m', '--method', choices=METHODS,
     help='Select method to use for determining connection information. "ping" uses the ping '
-         'command, "curl" uses the curl command to send an HTTP GET request to the server\'s root '
-         '("/") path, "httplib" makes an HTTP GET request to the selected captive portal detector, '
-         'and "polo" uses a special challenge/response protcol over HTTP. "httplib" and "polo" '
-         'check if the server returned the expected result. If the request succeeded but is not '
-         'what was expected, this counts as an offline result, and this interception is '
-         'represented in the status display with a "!". The "polo" method can only be used with '
-         'the "{}" server. Default: %(default)s'.format(POLO_SERVER))
+         'command, "icmp" sends the same ICMP echo requests from this process, without running a '
+         'command each time (this needs root, or an unprivileged ping socket, allowed by the '
+         'net.ipv4.ping_group_range sysctl), "curl" uses the curl command to send an HTTP GET '
+         'request to the server\'s root ("/") path, "connect" times the TCP connection to port 80 '
+         'like curl does, but from this process, "head" does the same and also checks for an HTTP '
+         'response to a HEAD request (so it succeeds and fails when curl would), "httplib" makes '
+         'an HTTP GET request to the selected captive portal detector, and "polo" uses a special '
+         'challenge/response protcol over HTTP. "httplib" and "polo" check if the server returned '
+         'the expected result. If the request succeeded but is not what was expected, this counts '
+         'as an offline result, and this interception is represented in the status display with a '
+         '"!". The "polo" method can only be used with the "{}" server. "race" sends the "httplib" '
+         'request to every detector at once ("polo" for "{}"), and takes the result as soon as '
+         '--quorum of them agree, so one slow, blocked or cached detector can\'t decide it. '
+         '"persistent" makes the "httplib" request (or "polo", for "{}") over one connection which '
+         'is kept open between pings, and reports the round trip time the kernel measures over its '
+         'whole life, instead of a new handshake (Linux only). Default: %(default)s'
+         .format(POLO_SERVER, POLO_SERVER, POLO_SERVER))
   opts['timeout'] = parser.add_argument('-t', '--timeout', type=int,
     help='Seconds to wait for a response to each ping. Cannot be greater than "frequency". '
          'Default: %(default)s')
+  opts['quorum'] = parser.add_argument('-q', '--quorum', type=int,
+    help='For the "race" method, how many detectors have to agree on the result. If they never '
+         'do, the worst result wins: intercepted, then offline. Default: %(default)s')
+  opts['dns_refresh'] = parser.add_argument('-d', '--dns-refresh', metavar='N', type=int,
+    help='DNS answers are cached for as long as their TTL, but do a fresh lookup every N pings '
+         'anyway, so DNS failures still show up. 1 disables the cache, and 0 always trusts it. '
+         'Doesn\'t apply to the "ping" and "curl" methods, which do their own lookups. Default: '
+         '%(default)s')
   opts['logfile'] = parser.add_argument('-L', '--logfile', type=os.path.abspath,
     help='Give a file to log ping history to. Will record the ping latency, the time, and if '
          'possible, the wifi SSID and MAC address (using the iwconfig" command). These will be in '
@@ -94,7 +138,14 @@ def make_parser():
          'upview.py. N.B.: If you aren\'t connected to wifi, the SSID and MAC address fields will '
          'be empty (but present). If you\'re connected, but the pings aren\'t going through the '
          'wifi connection, the SSID will be empty but the MAC will be the address of whatever '
-         'device you\'re actually using (like an Ethernet switch).')
+         'device you\'re actually using (like an Ethernet switch). For the "httplib" and "polo" '
+         'methods, the next two columns are the IP address connected to and whether it was IPv4 '
+         'or IPv6, and the last four are the milliseconds spent on the DNS lookup, the TCP '
+         'handshake, waiting for the response headers, and reading the body. The "race" method '
+         'logs a line for each detector, with its own latency and result, once they\'ve all '
+         'finished. For the "persistent" method, four more columns follow: the smoothed round '
+         'trip time and its variance (in milliseconds), the number of packets retransmitted since '
+         'the last ping, and the number currently thought lost.')
   opts['data_dir'] = parser.add_argument('-D', '--data-dir', metavar='DIRNAME', type=os.path.abspath,
     help='The directory where data will be stored. History data will be kept in DIRNAME/'
          +HISTORY_FILENAME+', the status display will be in DIRNAME/'+STATUS_FILENAME+', and '
@@ -124,11 +175,20 @@ def main():
   config = ConfigParser.RawConfigParser()
   write_config(config_file, config, args)
 
+  # Read in the history from file. This only happens at startup. After that, it's kept in memory.
+  history = collections.deque(maxlen=args.history_length)
+  if os.path.isfile(history_file):
+    history.extend(sorted(get_history(history_file, args.history_length)))
+  elif os.path.exists(history_file):
+    fail('Error: history file "'+history_file+'" is a non-file.')
+  prune_history(history, args.history_length - 1, args.frequency)
+  # "written" remembers what was last written to each file, so unchanged ones aren't rewritten.
+  state = {'history':history, 'written':{}}
+
   # Attach signal handler to write special status on shutdown or exception.
   # Define here to have access to have access to the status filename.
   def invalidate_status():
-    with open(status_file, 'w') as filehandle:
-      filehandle.write(SHUTDOWN_STATUS)
+    write_file(status_file, SHUTDOWN_STATUS.encode('utf8'), state['written'])
   def invalidate_and_exit(*args):
     invalidate_status()
     os.remove(config_file)
@@ -144,8 +204,35 @@ def main():
   sys.excepthook = invalidate_and_reraise
 
   # What version of ping?
+  ping_ver = None
   if args.method == 'ping':
     ping_ver = pings.get_ping_version()
+  # Open the ICMP socket once, to reuse it for every ping.
+  pinger = None
+  if args.method == 'icmp':
+    try:
+      pinger = pings.IcmpPinger()
+    except socket.error as error:
+      fail('Error: Could not open an ICMP socket ({}). Run as root, or allow ping sockets with the '
+           'net.ipv4.ping_group_range sysctl.'.format(error))
+
+  # Each ping runs in its own thread, so a slow one can't delay the next. They put their results
+  # on this queue, for the main thread to record while it waits to launch the next ping.
+  results = Queue.Queue()
+  shared = {'lock':threading.Lock(), 'log_lock':threading.Lock(), 'ping_ver':ping_ver,
+            'pinger':pinger, 'persistent':None}
+  def record_results(seconds):
+    try:
+      (sent, status, probe_args) = results.get(timeout=seconds)
+    except Queue.Empty:
+      return
+    if not os.path.isfile(silence_file):
+      state['history'] = record_result(state['history'], sent, status, probe_args, state['written'])
+
+  watcher = ConfigWatcher(config_file)
+  # The pings get this copy of the args instead of the live ones. It's only replaced when the config
+  # changes, and nothing modifies it, so the pings can all share it.
+  snapshot = copy.deepcopy(args)
 
   # Main loop.
   now = int(time.time())
@@ -153,86 +240,195 @@ def main():
   while True:
     if os.path.isfile(silence_file):
       invalidate_status()
-      target = sleep(target, args.frequency)
+      target = sleep(target, args.frequency, idle=record_results)
       continue
 
-    # Read in config file and update args with new settings.
-    old_args = copy.deepcopy(args)
-    changed = False
-    try:
-      config = ConfigParser.RawConfigParser()
-      config.read(config_file)
-      changed = read_config_args(config, args, opts)
-      check_config(args, old_args)
-      if config.has_option('meta', 'die') and config.get('meta', 'die').lower() == 'true':
-        invalidate_and_exit()
-    except ConfigParser.Error:
-      # Keeping the process up takes precedence over changing settings on the fly.
-      pass
-    (history_file, status_file, config_file) = make_paths(args.data_dir)
-    # Update config file with new settings.
-    if changed:
+    # Read in config file and update args with new settings, if the file has changed.
+    # This happens between pings, and the pings only see the snapshot taken once it's done, so a
+    # ping never sees a half-applied change.
+    if watcher.changed():
+      old_args = copy.deepcopy(args)
+      changed = False
       try:
         config = ConfigParser.RawConfigParser()
-        write_config(config_file, config, args)
+        config.read(config_file)
+        changed = read_config_args(config, args, opts)
+        check_config(args, old_args)
+        if config.has_option('meta', 'die') and config.get('meta', 'die').lower() == 'true':
+          invalidate_and_exit()
       except ConfigParser.Error:
+        # Keeping the process up takes precedence over changing settings on the fly.
         pass
+      (history_file, status_file, config_file) = make_paths(args.data_dir)
+      # Update config file with new settings.
+      if changed:
+        try:
+          config = ConfigParser.RawConfigParser()
+          write_config(config_file, config, args)
+        except ConfigParser.Error:
+          pass
+      if config_file != watcher.path:
+        watcher.close()
+        watcher = ConfigWatcher(config_file)
+      else:
+        # Don't react to our own write.
+        watcher.changed()
+      snapshot = copy.deepcopy(args)
 
-    # Read in history from file.
-    history = []
-    if os.path.isfile(history_file):
-      history = get_history(history_file, args.history_length)
-    elif os.path.exists(history_file):
-      fail('Error: history file "'+history_file+'" is a non-file.')
-    # Remove outdated pings.
+    # Launch the ping, stamped with the time it was sent.
+    pings.DNS_CACHE.refresh_every = args.dns_refresh
     now = int(time.time())
-    prune_history(history, args.history_length - 1, args.frequency, now=now)
-
-    # Determine the server domain name we're using.
-    if args.method in ('httplib', 'polo'):
-      server_name = DETECTOR_ALIASES.get(args.server, args.server)
-      detector = DETECTORS[server_name]
-      server = detector['server']
+    thread = threading.Thread(target=run_probe, args=(snapshot, now, shared, results))
+    thread.daemon = True
+    thread.start()
+
+    target = sleep(target, args.frequency, idle=record_results)
+
+
+def run_probe(args, now, shared, results):
+  """Ping according to "args", put the result on the "results" queue as
+  (now, status, args), and log it, if there's a logfile. "now" is the time the
+  ping was sent. This runs in its own thread, so pings can overlap. "shared"
+  holds the objects reused between pings, and the locks which keep two pings
+  from using them (or the log file) at once."""
+  try:
+    (server, result, intercepted, details, race) = ping_once(args, shared)
+  except Exception:
+    # The main thread never sees exceptions from this one, so count it as a dropped ping instead of
+    # losing it.
+    sys.stderr.write('Error: Ping failed unexpectedly:\n'+traceback.format_exc())
+    (server, result, intercepted, details, race) = (args.server, 0.0, None, {}, None)
+  status = get_status(result, intercepted)
+  results.put((now, status, args))
+
+  # Log result. This comes after the status is out, since getting the wifi info runs several
+  # commands, and the stragglers in a race can take a while.
+  if args.logfile:
+    if race is None:
+      entries = [(result, status, server, details)]
     else:
-      server = args.server
+      race.join()
+      entries = []
+      for name, (latency, detector_intercepted, detector_details) in sorted(race.results.items()):
+        entries.append((latency, get_status(latency, detector_intercepted),
+                        DETECTORS[name]['server'], detector_details))
+    with shared['log_lock']:
+      for (entry_result, entry_status, entry_server, entry_details) in entries:
+        log(args.logfile, entry_result, now, entry_status, args.method, entry_server,
+            details=entry_details)
+
+
+def ping_once(args, shared):
+  """Do the ping for run_probe(). Returns the server pinged, the latency, whether
+  it was intercepted, its details, and the pings.PingRace for the "race"
+  method (otherwise None)."""
+  # Determine the server domain name we're using.
+  if args.method in ('httplib', 'polo', 'persistent'):
+    server_name = DETECTOR_ALIASES.get(args.server, args.server)
+    detector = DETECTORS[server_name]
+    server = detector['server']
+  else:
+    server = args.server
+
+  # Close the persistent connection if it's no longer wanted.
+  with shared['lock']:
+    persistent = shared['persistent']
+    if persistent is not None and (args.method != 'persistent' or persistent.server != server
+                                   or persistent.timeout != args.timeout):
+      persistent.close()
+      shared['persistent'] = None
+
+  # Ping and get status.
+  details = {}
+  race = None
+  if args.method == 'race':
+    race = pings.PingRace(make_probes(DETECTORS, args.timeout))
+    race.start()
+    result, intercepted = race.wait(args.quorum)
+  elif args.method == 'httplib':
+    result, intercepted = pings.ping_and_check(timeout=args.timeout, details=details, **detector)
+  elif args.method == 'polo':
+    result, intercepted = pings.ping_with_challenge(timeout=args.timeout, details=details,
+                                                    **detector)
+  elif args.method == 'persistent':
+    with shared['lock']:
+      if shared['persistent'] is None:
+        shared['persistent'] = pings.PersistentProbe(timeout=args.timeout,
+                                                     challenge=server_name == POLO_SERVER,
+                                                     **detector)
+      result, intercepted = shared['persistent'].probe(details)
+  elif args.method == 'icmp':
+    with shared['lock']:
+      result = pings.ping(server, method=args.method, timeout=args.timeout,
+                          pinger=shared['pinger'])
+    intercepted = None
+  else:
+    result = pings.ping(server, method=args.method, timeout=args.timeout,
+                        ping_ver=shared['ping_ver'])
+    intercepted = None
+  return server, result, intercepted, details, race
+
+
+def record_result(history, now, status, args, written):
+  """Add a ping result to the in-memory "history" (a deque holding the last
+  --history-length points), then write out the history and status files, if
+  they changed. "now" is the time the ping was sent and "args" are the settings
+  it used. See write_file() for "written". Returns the history, which is a new
+  deque if --history-length changed."""
+  (history_file, status_file, config_file) = make_paths(args.data_dir)
 
-    # Ping and get status.
-    if args.method == 'httplib':
-      result, intercepted = pings.ping_and_check(timeout=args.timeout, **detector)
-    elif args.method == 'polo':
-      result, intercepted = pings.ping_with_challenge(timeout=args.timeout, **detector)
-    else:
-      result = pings.ping(server, method=args.method, timeout=args.timeout, ping_ver=ping_ver)
-      intercepted = None
-    if result:
-      if intercepted is True:
-        status = 'intercepted'
-      else:
-        status = 'up'
-    else:
-      status = 'down'
+  if history.maxlen != args.history_length:
+    history = collections.deque(history, maxlen=args.history_length)
+  if history and now < history[-1][0]:
+    # Pings can finish out of order, but the history is kept in the order they were sent.
+    points = sorted(list(history) + [(now, status)])
+    history.clear()
+    history.extend(points)
+  else:
     history.append((now, status))
+  # Remove outdated pings.
+  prune_history(history, args.history_length - 1, args.frequency, now=history[-1][0])
+
+  # Write new history back to file.
+  if os.path.exists(history_file) and not os.path.isfile(history_file):
+    fail('Error: history file "'+history_file+'" is a non-file.')
+  write_history(history_file, history, written)
+
+  # Write status stat to file (or stdout).
+  if os.path.exists(status_file) and not os.path.isfile(status_file):
+    fail('Error: status file "'+status_file+'" is a non-file.')
+  status_str = status_format(history, args.history_length)
+  if args.stdout:
+    print(status_str)
+  else:
+    write_file(status_file, status_str.encode('utf8'), written)
+  return history
 
-    # Log result.
-    if args.logfile:
-      log(args.logfile, result, now, status, args.method, server)
-
-    # Write new history back to file.
-    if os.path.exists(history_file) and not os.path.isfile(history_file):
-      fail('Error: history file "'+history_file+'" is a non-file.')
-    write_history(history_file, history)
-
-    # Write status stat to file (or stdout).
-    if os.path.exists(status_file) and not os.path.isfile(status_file):
-      fail('Error: status file "'+status_file+'" is a non-file.')
-    status_str = status_format(history, args.history_length)
-    if args.stdout:
-      print(status_str)
-    else:
-      with open(status_file, 'w') as filehandle:
-        filehandle.write(status_str.encode('utf8'))
 
-    target = sleep(target, args.frequency)
+def make_probes(detectors, timeout):
+  """Make a pings.PingRace probe function for each detector, using the "polo"
+  method for POLO_SERVER and "httplib" for the rest."""
+  probes = {}
+  for name, detector in detectors.items():
+    if name == POLO_SERVER:
+      ping_func = pings.ping_with_challenge
+    else:
+      ping_func = pings.ping_and_check
+    def probe(details, ping_func=ping_func, detector=detector):
+      return ping_func(timeout=timeout, details=details, **detector)
+    probes[name] = probe
+  return probes
+
+
+def get_status(result, intercepted):
+  """Turn a ping's latency and interception result into a history status."""
+  if result:
+    if intercepted is True:
+      return 'intercepted'
+    else:
+      return 'up'
+  else:
+    return 'down'
 
 
 def make_paths(data_dir):
@@ -251,6 +447,79 @@ def make_paths(data_dir):
   return (history_file, status_file, config_file)
 
 
+class ConfigWatcher(object):
+  """Tell whether a file has changed since the last check. On Linux, this uses
+  inotify, watching the file's directory so it also notices the file being
+  replaced (like editors do). Otherwise, it compares the file's mtime, size and
+  inode on each check."""
+
+  def __init__(self, path):
+    self.path = path
+    self.name = os.path.basename(path)
+    if not isinstance(self.name, bytes):
+      self.name = self.name.encode('utf8')
+    self.stat = get_file_stat(path)
+    try:
+      self.fd = inotify_watch(os.path.dirname(path))
+    except (OSError, AttributeError):
+      self.fd = None
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def changed(self):
+    if self.fd is None:
+      stat = get_file_stat(self.path)
+      changed = stat != self.stat
+      self.stat = stat
+      return changed
+    changed = False
+    while True:
+      try:
+        data = os.read(self.fd, 4096)
+      except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return changed
+        raise
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+        start = offset + INOTIFY_EVENT.size
+        name = data[start:start+length].rstrip(b'\0')
+        if name == self.name or mask & IN_Q_OVERFLOW:
+          changed = True
+        offset = start + length
+
+
+def inotify_watch(dirname, mask=INOTIFY_MASK):
+  """Start watching a directory with inotify. Returns the inotify file
+  descriptor, in non-blocking mode. Raises AttributeError if the system has no
+  inotify, or OSError if it fails."""
+  libc = ctypes.CDLL(None, use_errno=True)
+  fd = libc.inotify_init1(os.O_NONBLOCK)
+  if fd < 0:
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+  if not isinstance(dirname, bytes):
+    dirname = dirname.encode('utf8')
+  if libc.inotify_add_watch(fd, dirname, mask) < 0:
+    error = ctypes.get_errno()
+    os.close(fd)
+    raise OSError(error, os.strerror(error))
+  return fd
+
+
+def get_file_stat(path):
+  """Return the (mtime, size, inode) of the file, or None if it doesn't exist."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
 def is_running(config_file):
   """Determine if an instance is already running by reading its pid from a
   config file.
@@ -340,6 +609,16 @@ def check_config(args, old_args=None):
     else:
       args.timeout = old_args.timeout
       args.frequency = old_args.frequency
+  if args.dns_refresh < 0:
+    if old_args is None:
+      raise AssertionError('DNS refresh interval cannot be negative.')
+    else:
+      args.dns_refresh = old_args.dns_refresh
+  if not 1 <= args.quorum <= len(DETECTORS):
+    if old_args is None:
+      raise AssertionError('Quorum must be between 1 and {}.'.format(len(DETECTORS)))
+    else:
+      args.quorum = old_args.quorum
   if args.method not in METHODS:
     if old_args is None:
       raise AssertionError('Ping method must be one of "{}".'.format('", "'.join(METHODS)))
@@ -355,7 +634,8 @@ def check_config(args, old_args=None):
       raise AssertionError('Given log file is an invalid pathname.')
     else:
       args.logfile = old_args.logfile
-  if args.method == 'httplib' and args.server not in DETECTOR_ALIASES and args.server not in DETECTORS:
+  if (args.method in ('httplib', 'persistent') and args.server not in DETECTOR_ALIASES
+      and args.server not in DETECTORS):
     if old_args is None:
       raise AssertionError('Server not in list of captive portal detectors.')
     else:
@@ -392,38 +672,68 @@ def get_history(history_file, history_length):
 def prune_history(history, past_points, frequency, now=None):
   """Remove history points older than a cutoff age.
   The cutoff is calculated to ideally retain "past_points" points, assuming
-  pings have consistently been sent every "frequency" seconds. See get_history()
-  for the format of the "history" data structure."""
+  pings have consistently been sent every "frequency" seconds. "history" is a
+  deque of points in the format from get_history(), sorted by time."""
   if now is None:
     now = int(time.time())
   cutoff = now - (frequency * past_points) - 2  # 2 second fudge factor
-  history[:] = [line for line in history if line[0] >= cutoff]
+  while history and history[0][0] < cutoff:
+    history.popleft()
   return history
 
 
-def write_history(history_file, history):
+def write_history(history_file, history, written=None):
   """Write the current history data structure to the history file.
-  See get_history() for the format of the "history" data structure."""
-  with open(history_file, 'w') as filehandle:
-    for (timestamp, status) in history:
-      filehandle.write("{}\t{}\n".format(timestamp, status))
+  See get_history() for the format of the "history" data structure, and
+  write_file() for "written"."""
+  lines = ["{}\t{}\n".format(timestamp, status) for (timestamp, status) in history]
+  write_file(history_file, ''.join(lines), written)
+
+
+def write_file(path, content, written=None):
+  """Write "content" to a temporary file and rename it to "path", so readers
+  never see it half-written. If "written" is a dict, it's used to remember what
+  was last written to each path, and the write is skipped if nothing changed.
+  Returns True if the file was written."""
+  if written is not None and written.get(path) == content:
+    return False
+  temp_path = path+'.tmp'
+  with open(temp_path, 'w') as filehandle:
+    filehandle.write(content)
+  os.rename(temp_path, path)
+  if written is not None:
+    written[path] = content
+  return True
 
 
-def log(logfile, result, now, status, method, server):
+def log(logfile, result, now, status, method, server, details=None):
   """Log the result of the ping to the given log file.
   Writes the ping milliseconds ("result"), current timestamp ("now"), wifi SSID,
   and wifi MAC address as separate columns in a line appended to the file.
   If you're not connected to wifi, or if it isn't your default interface, the
   SSID column will be empty and the MAC address will be of whatever device
-  your default interface is attached to (the default route)."""
-  (wifi_interface, ssid, mac) = ipwraplib.get_wifi_info()
-  (active_interface, default_route) = ipwraplib.get_default_route()
-  if wifi_interface != active_interface:
+  your default interface is attached to (the default route). After the method,
+  server and status come the address and family from "details", if any, then
+  the milliseconds taken by each phase in its "timings" (see pings.TIMINGS), and
+  the connection statistics in its "tcp_info" (see pings.TCP_STATS).
+  The network details come from ipwraplib.NETWORK_CONTEXT, which only runs the
+  commands to find them again when the network changes."""
+  network = ipwraplib.NETWORK_CONTEXT.get()
+  ssid = network['ssid']
+  mac = network['mac']
+  if network['wifi_interface'] != network['interface']:
     ssid = ''
-    mac = ipwraplib.get_mac_from_ip(default_route)
+    mac = network['gateway_mac']
   if status == 'intercepted':
     result = 0
-  columns = [result, now, ssid, mac, method, server, status]
+  if details is None:
+    details = {}
+  columns = [result, now, ssid, mac, method, server, status, details.get('address'),
+             details.get('family')]
+  timings = details.get('timings', {})
+  columns.extend([timings.get(name) for name in pings.TIMINGS])
+  tcp_info = details.get('tcp_info', {})
+  columns.extend([tcp_info.get(name) for name in pings.TCP_STATS])
   line = "\t".join(map(format_value, columns))+'\n'
   with open(logfile, 'a') as filehandle:
     filehandle.write(line)
@@ -460,9 +770,10 @@ def status_format(history, history_length):
   return status_str.lstrip()
 
 
-def sleep(target, delay=5, precision=0.1):
+def sleep(target, delay=5, precision=0.1, idle=time.sleep):
   """Sleep until "target" (unix timestamp), and return a new target "delay"
-  seconds later. It does this by sleeping in increments of "precision" seconds.
+  seconds later. It does this by sleeping in increments of "precision" seconds,
+  by calling idle(precision), which can do other work in the meantime.
   To accommodate system suspend and other pauses in execution, if the current
   time is more than one step (increment of "delay") beyond "target", then the
   target will be raised by a multiple of delay until it's one step below the
@@ -475,7 +786,7 @@ def sleep(target, delay=5, precision=0.1):
   if now > target:
     target += delay * ((now - target) // delay)
   while now < target:
-    time.sleep(precision)
+    idle(precision)
     now = int(time.time())
   return target + delay
 